@@ -265,9 +265,11 @@ class S3_File(metaclass=MetaRecord):
     OutputKeyPrefix = "/".join(Key.split("/")[:-1])
 
     jobcls = None
+    jobkw = {}
 
     if self.Input_Type == "Video":
       jobcls = TranscodeVideoJob
+      jobkw['Adaptive'] = AWSClient.Config.AdaptiveVideo
 
     elif self.Input_Type == "ShockBoxImage":
       jobcls = ResizeImageJob
@@ -289,7 +291,7 @@ class S3_File(metaclass=MetaRecord):
       raise ValueError('For some reason, the job for S3_File_MNID={0} did not have a valid input type of "{1}".'.format(self.S3_File_MNID, self.Input_Type))
 
     # Instantiate the job object and return its JSON representation
-    return jobcls(InputKey=Key, OutputKeyPrefix=OutputKeyPrefix)
+    return jobcls(InputKey=Key, OutputKeyPrefix=OutputKeyPrefix, **jobkw)
 
   ###############################################################################
   @classmethod
@@ -430,17 +432,18 @@ class S3_File_Document(metaclass=MetaRecord):
       doc.Save()
 
       # Save versions
-      for i, output in enumerate(AWSResponse["Outputs"]):
-        # The first element is always the converted output file
-        if i == 0:
+      for output in AWSResponse["Outputs"]:
+        # The converted files come first (the PDF, then any other exported format), then the pages
+        if "PageNumber" not in output:
+          DocumentVersion = output.get("Type", "PDF")
           # Create the version records
           try:
-            docversion = S3_File_Document_Version(S3_File_MNID, 'PDF')
+            docversion = S3_File_Document_Version(S3_File_MNID, DocumentVersion)
           except App.DB.NotOneFound:
             docversion = S3_File_Document_Version(None, None)
             docversion.S3_File_MNID = S3_File_MNID
           # Save the modified props
-          docversion.DocumentVersion = "PDF"
+          docversion.DocumentVersion = DocumentVersion
           docversion.Arn = "arn:aws:s3:::{0}/{1}/{2}".format(
             OutputBucket,
             AWSResponse["OutputKeyPrefix"],
@@ -451,7 +454,7 @@ class S3_File_Document(metaclass=MetaRecord):
           # Create the page records
           quality = 'Regular' if output["Key"].find('.1200x1200.') > -1 else 'Thumbnail'
           try:
-            docpage = S3_File_Document_Page(S3_File_MNID, i, quality)
+            docpage = S3_File_Document_Page(S3_File_MNID, output["PageNumber"], quality)
           except App.DB.NotOneFound:
             docpage = S3_File_Document_Page(None, None, None)
             docpage.S3_File_MNID = S3_File_MNID
@@ -461,6 +464,9 @@ class S3_File_Document(metaclass=MetaRecord):
           docpage.Width = output["Width"]
           docpage.Height = output["Height"]
           docpage.ImageType = output["Type"]
+          # Pages packed in a sprite sheet share its image, at the offset of their cell
+          docpage.SpriteX = output.get("SpriteX")
+          docpage.SpriteY = output.get("SpriteY")
           docpage.Arn = "arn:aws:s3:::{0}/{1}/{2}".format(
             OutputBucket,
             AWSResponse["OutputKeyPrefix"],
@@ -553,6 +559,14 @@ class S3_File_Document_Page(metaclass=MetaRecord):
   class ImageType(StringField):
     Flags = +Read +Write
 
+  #============================================================================
+  class SpriteX(IntegerField):
+    Flags = +Read +Write
+
+  #============================================================================
+  class SpriteY(IntegerField):
+    Flags = +Read +Write
+
   #============================================================================
   class Arn(StringField):
     Flags = +Read +Write
@@ -707,7 +721,13 @@ class S3_File_Video(metaclass=MetaRecord):
           vid.VideoDuration = output["duration"]
           vid.Save()
         # Create the video version
-        VideoVersion = "Web" if output['key'].endswith('mp4') else "Webm"
+        if output['key'].endswith('.m3u8'):
+          # The master playlist of the adaptive stream
+          VideoVersion = "HLS"
+        elif output['key'].endswith('mp4'):
+          VideoVersion = "Web"
+        else:
+          VideoVersion = "Webm"
         try:
           vidversion = S3_File_Video_Version(S3_File_MNID, VideoVersion)
         except App.DB.NotOneFound:
@@ -1,6 +1,7 @@
 # vim:fileencoding=utf-8:ts=2:sw=2:expandtab
 
 import json
+import posixpath
 import mimetypes
 import traceback
 from datetime import datetime, timezone, timedelta
@@ -10,6 +11,7 @@ from AppStruct.Util import aadict
 from AppStruct.Security import RandomHex
 
 from ..Base import GetSession, S3, SQS
+from ..JobSpecification import RenderPagesJob
 from . import AWS
 
 
@@ -36,11 +38,13 @@ class AWSConfig(object):
     self.KeyPrefix = ConfigDict["keyprefix"]
     self.InputBucket = ConfigDict["input_bucket"]
     self.OutputBucket = ConfigDict["output_bucket"]
+    # Optional: adaptive streams of the videos, they need a video backend that produces them
+    self.AdaptiveVideo = bool(ConfigDict.get("adaptive_video", False))
 
 
 class Client(object):
 
-  SchemaVersion = '1.0.0'
+  SchemaVersion = '1.2.0'
 
   def __init__(self, *, Config, Schema):
     self.Schema = Schema
@@ -181,14 +185,8 @@ class Client(object):
   def S3_TranscodeStatusCheck(self, S3_File_ESID):
     s3file = AWS.S3_File.FindByESID(S3_File_ESID=S3_File_ESID)
 
-    key = s3file.Input_Arn.split(':')[-1].replace("{0}/".format(self.Config.OutputBucket), "").replace('input.dat', 'output.json')
-
     # check if the output file is available yet
-    jdict = S3.GetJSON(
-      session=self.Session,
-      bucket=self.Config.OutputBucket,
-      key=key
-      )
+    jdict = self.S3_GetOutputForFile(s3file)
 
     if not jdict:
       #TODO: let's check and see if too long has passed, we will update this with an error message
@@ -208,13 +206,83 @@ class Client(object):
 
     return s3file
 
+  ###############################################################################
+  def S3_GetOutputForFile(self, S3_File):
+    """
+    Read the output.json written by the job processing this file
+
+    Returns None until the job has written anything
+    """
+    key = S3_File.Input_Arn.split(':')[-1].replace("{0}/".format(self.Config.OutputBucket), "").replace('input.dat', 'output.json')
+
+    return S3.GetJSON(
+      session=self.Session,
+      bucket=self.Config.OutputBucket,
+      key=key
+      )
+
+  ###############################################################################
+  def S3_PreviewForFile(self, S3_File_ESID, expiresin=10800):
+    """
+    Get the first page of a document that is still being processed
+
+    Returns
+
+    aadict(src = ..., NumPages = ..., Width = ..., Height = ...)
+
+    or None when the job is not progressing or no page is ready yet
+    """
+    s3file = AWS.S3_File.FindByESID(S3_File_ESID=S3_File_ESID)
+
+    jdict = self.S3_GetOutputForFile(s3file)
+
+    if not jdict or jdict['state'] != 'PROGRESSING' or not jdict.get('Preview'):
+      return None
+
+    preview = jdict['Preview']
+
+    return aadict(
+      src = S3.GetSignedUrl(self.Session, self.Config.OutputBucket, preview['Key'], expiresin),
+      NumPages = jdict['Input'].get('NumPages'),
+      Width = preview['Width'],
+      Height = preview['Height'],
+      )
+
+  ###############################################################################
+  def S3_RenderDocumentPages(self, S3_File_ESID, FirstPage, LastPage):
+    """
+    Ask for a range of pages of a long document to be rendered
+
+    Only the first pages of long documents are rendered by the conversion, the others
+    are rendered on demand. Pages already rendered are skipped, and the new pages are
+    added to the document by S3_TranscodeStatusCheck once the job is done.
+
+    Returns the message id of the job
+    """
+    s3file = AWS.S3_File.FindByESID(S3_File_ESID=S3_File_ESID)
+
+    if s3file.Input_Type != 'Document':
+      raise ValueError('S3_File_ESID={0} is not a document.'.format(S3_File_ESID))
+
+    Bucket, Key = self.GetBucketAndKeyFromArn(s3file.Input_Arn)
+    jobparams = RenderPagesJob(
+      InputKey=Key,
+      OutputKeyPrefix="/".join(Key.split("/")[:-1]),
+      FirstPage=FirstPage,
+      LastPage=LastPage,
+      )
+
+    # Post message to SQS
+    message = SQS.PostMessage(self.Session, self.Config.QueueUrl, jobparams.ToJSON())
+    return {"Message": message.message_id}
+
   ###############################################################################
   def S3_SignedUrlForFile(self, S3_File, expiresin=10800):
     bucket, key = self.GetBucketAndKeyFromArn(S3_File.Input_Arn)
     return S3.GetSignedUrl(self.Session, bucket, key, expiresin)
 
   ###############################################################################
-  def S3_ServeVideoVersionMap(self, S3_File_MNID, expiresin=10800):
+  def S3_ServeVideoVersionMap(self, S3_File_MNID, expiresin=10800, PlaylistUrl=None):
     """
     Create the URIs for serving different video versions of this file
 
@@ -227,13 +295,17 @@ class Client(object):
     """
 
     s3file = AWS.S3_File(S3_File_MNID)
-    return self.S3_ServeVideoVersionMapForS3File(s3file)
+    return self.S3_ServeVideoVersionMapForS3File(s3file, expiresin, PlaylistUrl=PlaylistUrl)
 
   ###############################################################################
-  def S3_ServeVideoVersionMapForS3File(self, s3file, expiresin=10800):
+  def S3_ServeVideoVersionMapForS3File(self, s3file, expiresin=10800, PlaylistUrl=None):
     """
     Create the URIs for serving different video versions of this file
 
+    The playlists of the HLS version cannot be signed URLs since they refer to other files
+    of the stream, the application serves them with S3_ServeHLSPlaylist instead. PlaylistUrl
+    is the URL of its master playlist, the HLS version is only listed when it is given.
+
     Returns
 
     OrderedDict {
@@ -255,8 +327,15 @@ class Client(object):
     for version in s3file.GetVideoVersionList():
       bucket, key = self.GetBucketAndKeyFromArn(version["Arn"])
 
+      if version.VideoVersion == 'HLS':
+        if not PlaylistUrl:
+          continue
+        src = PlaylistUrl
+      else:
+        src = S3.GetSignedUrl(self.Session, bucket, key, expiresin)
+
       OutputMap[version.VideoVersion] = aadict(
-        src = S3.GetSignedUrl(self.Session, bucket, key, expiresin),
+        src = src,
         type = version.HTML_Type,
         )
 
@@ -264,6 +343,41 @@ class Client(object):
 
     return OutputMap or None
 
+  ###############################################################################
+  def S3_ServeHLSPlaylist(self, S3_File_MNID, Path='master.m3u8', expiresin=10800):
+    """
+    Get a playlist of the HLS version of this file, with its segments signed
+
+    The application serves the playlists under a URL of its own, ending with the path of
+    the playlist relative to the master playlist, so that the players find the playlists
+    of the renditions next to it.
+
+    EX: /video/1234/hls/master.m3u8 serves S3_ServeHLSPlaylist(1234)
+        /video/1234/hls/480p/playlist.m3u8 serves S3_ServeHLSPlaylist(1234, '480p/playlist.m3u8')
+
+    Returns the content of the playlist, or None if there is no such playlist
+    """
+    s3file = AWS.S3_File(S3_File_MNID)
+
+    versions = [v for v in s3file.GetVideoVersionList() if v.VideoVersion == 'HLS']
+    Path = posixpath.normpath(Path)
+    if not versions or not Path.endswith('.m3u8') or Path.startswith(('/', '..')):
+      return None
+
+    bucket, key = self.GetBucketAndKeyFromArn(versions[0]["Arn"])
+    key = posixpath.join(posixpath.dirname(key), Path)
+    content = S3.GetObject(session=self.Session, bucket=bucket, key=key)
+    if content is None:
+      return None
+
+    # Playlists are served by the application, every other file gets a signed url
+    lines = []
+    for line in content.decode('utf-8').splitlines():
+      if line and not line.startswith('#') and not line.endswith('.m3u8'):
+        line = S3.GetSignedUrl(self.Session, bucket, posixpath.join(posixpath.dirname(key), line), expiresin)
+      lines.append(line)
+    return '\n'.join(lines) + '\n'
+
   ###############################################################################
   def S3_File_Poll(self):
     numfiles = 0
@@ -39,6 +39,32 @@ WEBM_PRESET_DATA = {
     }}
 
 
+# Settings of the system preset used for the mp4 version, as applied by the local ffmpeg backend
+WEB_PRESET_DATA = {
+  'container': 'mp4',
+  'name': 'System preset: Generic 480p 16:9',
+  'description': 'System preset generic 480p 16:9',
+  'audio': {
+    'Codec': 'AAC',
+    'SampleRate': '44100',
+    'BitRate': '128',
+    'Channels': '2',
+    },
+  'video': {
+    'Codec': 'H.264',
+    'CodecOptions': {'Profile': 'main', 'Level': '3.1'},
+    'KeyframesMaxDist': '90',
+    'FixedGOP': 'false',
+    'BitRate': '1200',
+    'FrameRate': 'auto',
+    'MaxWidth': '854',
+    'MaxHeight': '480',
+    'SizingPolicy': 'ShrinkToFit',
+    'PaddingPolicy': 'NoPad',
+    'DisplayAspectRatio': 'auto'
+    }}
+
+
 def CreatePipeline(*, session, pipelinename, role_arn, inputbucketname, outputbucketname, topic_arn):
   # SEE: https://boto3.readthedocs.org/en/latest/topics/service_names.html#service-names for service names
   etconn = session.connect_to("elastictranscoder")
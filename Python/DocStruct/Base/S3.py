@@ -313,7 +313,7 @@ def GetJSON(*, session, bucket, key):
   return json.loads(obj.decode('utf-8'))
 
 
-def PutObject(*, session, bucket, key, content, type_="application/octet-stream"):
+def PutObject(*, session, bucket, key, content, type_="application/octet-stream", create_bucket=True):
   """Saves data to S3 under specified filename and bucketname
 
   :param session: The session to use for AWS connection
@@ -326,18 +326,21 @@ def PutObject(*, session, bucket, key, content, type_="application/octet-stream"
   :type content: bytes | str
   :param type_: Content type of the data to put
   :type type_: str
+  :param create_bucket: False when the caller already made sure the bucket exists, EX: for many uploads
+  :type create_bucket: bool
   :return: The new S3 object
   :rtype: boto3.core.resource.S3Object
   """
   s3conn = session.connect_to("s3")
   # Make sure, we have the bucket to add object to
-  try:
-    b = GetOrCreateBuckets(session, bucket)
-  except Exception as e:
-    # There is a chance that the user trying to PutObject does not have permissions
-    # to Create/List Buckets. In such cases and error is thrown. We can still try to
-    # save and assume the bucket already exists.
-    pass
+  if create_bucket:
+    try:
+      b = GetOrCreateBuckets(session, bucket)
+    except Exception as e:
+      # There is a chance that the user trying to PutObject does not have permissions
+      # to Create/List Buckets. In such cases and error is thrown. We can still try to
+      # save and assume the bucket already exists.
+      pass
   # Now we can create the object
   S3Objects = session.get_collection("s3", "S3ObjectCollection")
   s3objects = S3Objects(connection=s3conn, bucket=bucket, key=key)
@@ -349,6 +352,36 @@ def PutObject(*, session, bucket, key, content, type_="application/octet-stream"
   return s3objects.create(key=key, acl="private", content_type=type_, body=bindata)
 
 
+def CopyObject(*, session, source_bucket, source_key, bucket, key, type_=None):
+  """Copies an object to a new location without transferring its data through this host
+
+  :param session: The session to use for AWS connection
+  :type session: boto3.session.Session
+  :param source_bucket: Name of the bucket holding the object to copy
+  :type source_bucket: str
+  :param source_key: Key of the object to copy
+  :type source_key: str
+  :param bucket: Name of the bucket to copy to
+  :type bucket: str
+  :param key: Key under which the copy is saved
+  :type key: str
+  :param type_: If provided, replaces the content type of the copy
+  :type type_: str
+  :return: Response of the copy request
+  :rtype: dict
+  """
+  s3conn = session.connect_to("s3")
+  params = {
+    "bucket": bucket,
+    "key": key,
+    "acl": "private",
+    "copy_source": parse.quote("{0}/{1}".format(source_bucket, source_key)),
+  }
+  if type_:
+    params.update(content_type=type_, metadata_directive="REPLACE")
+  return s3conn.copy_object(**params)
+
+
 def PutJSON(*, session, bucket, key, content):
   """Saves JSON to S3
 
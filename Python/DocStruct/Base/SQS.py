@@ -36,7 +36,7 @@ def CreateQueue(session, queuename, message_retention_period=1209600, visibility
   return qmeta["QueueUrl"]
 
 
-def PostMessage(session, queueurl, message):
+def PostMessage(session, queueurl, message, delay_seconds=0):
   """Post a message to the given queue
 
   :param session: Session to use for AWS access
@@ -45,13 +45,18 @@ def PostMessage(session, queueurl, message):
   :type queueurl: str
   :param message: Body of message to post
   :type message: str
+  :param delay_seconds: Number of seconds before the message becomes visible in the queue (at most 900)
+  :type delay_seconds: int
   :return: The created message
   :rtype: object
   """
   sqsconn = session.connect_to("sqs")
   Messages = session.get_collection("sqs", "MessageCollection")
   messages = Messages(connection=sqsconn, queue_url=queueurl)
-  m = messages.create(message_body=message)
+  if delay_seconds:
+    m = messages.create(message_body=message, delay_seconds=min(int(delay_seconds), 900))
+  else:
+    m = messages.create(message_body=message)
   return m
 
 
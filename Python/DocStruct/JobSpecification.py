@@ -38,10 +38,15 @@ class TranscodeVideoJob(JobSpecification):
 
   Name = "TranscodeVideo"
 
+  def __init__(self, *, InputKey, OutputKeyPrefix, Adaptive=False):
+    super().__init__(InputKey=InputKey, OutputKeyPrefix=OutputKeyPrefix)
+    # Also stream the video over HLS, at the bitrate the player can sustain
+    self.Adaptive = Adaptive
+
   @property
   def ExtraParams(self):
     return {
-      "OutputFormats": ('webm', 'mp4')
+      "OutputFormats": ('webm', 'mp4', 'hls') if self.Adaptive else ('webm', 'mp4')
       }
 
 
@@ -50,11 +55,93 @@ class ConvertToPDFJob(JobSpecification):
 
   Name = "ConvertToPDF"
 
+  def __init__(self, *, InputKey, OutputKeyPrefix, ExtraOutputs=()):
+    super().__init__(InputKey=InputKey, OutputKeyPrefix=OutputKeyPrefix)
+    # (output key, format) of the other formats exported along with the PDF
+    # EX: (('output.odt', 'odt'), ('output.html', 'html'))
+    self.ExtraOutputs = ExtraOutputs
+
   @property
   def ExtraParams(self):
-    return {
+    ret = {
       "OutputKey": "output.pdf"
       }
+    if self.ExtraOutputs:
+      ret["ExtraOutputs"] = self.ExtraOutputs
+    return ret
+
+
+##################################################
+class ConvertDocumentsJob(JobSpecification):
+  """Converts many documents in a single session of the document converter, for bulk backfills"""
+
+  Name = "ConvertDocuments"
+
+  def __init__(self, *, Documents, OutputKey="output.pdf", ExtraOutputs=(), DirectRender=True, SpritePages=None, EagerPages=None, OptimizePDF=None, ExtractText=None, CacheConversions=None):
+    # (InputKey, OutputKeyPrefix) of every document
+    self.Documents = Documents
+    self.OutputKey = OutputKey
+    self.ExtraOutputs = ExtraOutputs
+    self.DirectRender = DirectRender
+    # Options left to None follow the config of the workers
+    self.SpritePages = SpritePages
+    self.EagerPages = EagerPages
+    self.OptimizePDF = OptimizePDF
+    self.ExtractText = ExtractText
+    self.CacheConversions = CacheConversions
+
+  @property
+  def ExtraParams(self):
+    ret = {
+      "OutputKey": self.OutputKey,
+      "DirectRender": self.DirectRender,
+      }
+    if self.ExtraOutputs:
+      ret["ExtraOutputs"] = self.ExtraOutputs
+    for name in ('SpritePages', 'EagerPages', 'OptimizePDF', 'ExtractText', 'CacheConversions'):
+      if getattr(self, name) is not None:
+        ret[name] = getattr(self, name)
+    return ret
+
+  def ToJSON(self):
+    # The documents take the place of the input and output of a single document
+    if not self.Documents or not all(InputKey and OutputKeyPrefix for InputKey, OutputKeyPrefix in self.Documents):
+      raise Exception("Documents is a required field, each with an InputKey and an OutputKeyPrefix.")
+    Params = {
+      "Documents": [[InputKey, OutputKeyPrefix] for InputKey, OutputKeyPrefix in self.Documents],
+      }
+    Params.update(self.ExtraParams)
+    return json.dumps({
+      "Type": "Job",
+      "Job": self.Name,
+      "Params": Params
+      })
+
+
+##################################################
+class RenderPagesJob(JobSpecification):
+  """Renders the thumbnails of a range of pages of a document already converted to PDF"""
+
+  def __init__(self, *, InputKey, OutputKeyPrefix, FirstPage, LastPage, OutputKey="output.pdf", DirectRender=True, SpritePages=None, Shard=False):
+    super().__init__(InputKey=InputKey, OutputKeyPrefix=OutputKeyPrefix)
+    self.FirstPage = FirstPage
+    self.LastPage = LastPage
+    self.OutputKey = OutputKey
+    self.DirectRender = DirectRender
+    self.SpritePages = SpritePages
+    # Ranges of a split document are merged together, the others are rendered on demand
+    self.Shard = Shard
+
+  @property
+  def ExtraParams(self):
+    return {
+      "OutputKey": self.OutputKey,
+      "FirstPage": self.FirstPage,
+      "LastPage": self.LastPage,
+      "DirectRender": self.DirectRender,
+      "SpritePages": self.SpritePages,
+      "Shard": self.Shard,
+      }
 
 
 ##################################################
@@ -71,6 +158,19 @@ class ResizeImageJob(JobSpecification):
       )}
 
 
+##################################################
+class DeepZoomImageJob(ResizeImageJob):
+  """Resizes the image and also builds a Deep Zoom tile pyramid for very large images"""
+
+  Name = "ResizeImage"
+
+  @property
+  def ExtraParams(self):
+    ret = super().ExtraParams
+    ret["PreferredOutputs"] += ((256, 256, 'DeepZoom.dzi'),)
+    return ret
+
+
 ##################################################
 class NormalizeImageJob(JobSpecification):
 
@@ -3,127 +3,1257 @@ import re
 import os
 import os.path
 import glob
+import gzip
+import json
+import hashlib
+import math
+import time
+import queue
+import socket
+import threading
 import mimetypes
 import subprocess
 
-from ..Base import S3
-from . import Job, S3BackedFile
+from concurrent.futures import ThreadPoolExecutor
+from ..Base import S3, SQS
+from ..JobSpecification import RenderPagesJob, ConvertDocumentsJob
+from . import Job, S3BackedFile, Binaries, Governor, JobTimeoutException, NoMoreRetriesException, PostponeJobException
+
+
+# Unix socket on which the document converter service of this host listens
+CONVERTER_SOCKET_PATH = '/tmp/docstruct-document-converter.sock'
+# Number of seconds to wait for a freshly started converter service to listen
+CONVERTER_STARTUP_TIMEOUT = 30
+# Number of seconds the startup check may take, enough for the service to start an office
+CONVERTER_CHECK_TIMEOUT = 120
+# Number of seconds a request to the converter service waits for an answer at the very least
+MIN_REQUEST_TIMEOUT = 1
+# Consecutive failures to reach an office after which conversions are postponed
+BREAKER_FAILURE_THRESHOLD = 3
+# Number of seconds conversions are postponed for before a single one is let through to probe the office
+BREAKER_RESET_TIMEOUT = 120
+# Number of seconds a postponed document job waits in the queue, SQS delays messages by 900 seconds at most
+BREAKER_POSTPONE_DELAY = 300
+# Number of documents ConvertDocuments downloads and converts at a time, the batch is done in such chunks
+BATCH_SIZE = 10
+# Maximum number of pages rendered by a single ghostscript process
+RASTERIZE_CHUNK_SIZE = 10
+# Resolution at which pages are rendered before being resampled to thumbnails
+RASTERIZE_RESOLUTION = 300
+# Maximum number of pages or thumbnails waiting between two stages of the page pipeline
+PIPELINE_QUEUE_SIZE = 8
+# Maximum number of thumbnails uploaded at the same time
+MAX_PAGE_UPLOADS = 4
+# Thumbnails made for every page, the first one being the regular thumbnail
+THUMBNAIL_SIZES = ((1200, 1200), (160, 160))
+# Number of columns of the sprite sheets in which small thumbnails may be packed
+SPRITE_COLUMNS = 10
+# Documents with more pages than this are split in page ranges rendered by the other workers
+SHARD_PAGES = 100
+# Where the page ranges of a split document record their results, relative to the output key prefix
+SHARDS_KEY_PREFIX = 'shards'
+# Where the page ranges rendered on demand record their results, relative to the output key prefix
+PAGES_KEY_PREFIX = 'pages'
+# Number of seconds a request for pages waits in the queue when the document is still being converted
+PAGES_POSTPONE_DELAY = 60
+# Resolution to which the images of an optimized PDF are downsampled, black and white images keep twice as much
+OPTIMIZE_RESOLUTION = 150
+# Key of the text of every page, relative to the output key prefix
+TEXT_KEY = 'text.json.gz'
+# Where converted documents are cached in the output bucket, by hash of the input and version of the converter
+CACHE_KEY_PREFIX = 'cache/conversions'
+# Number of bytes of the input hashed at a time
+HASH_CHUNK_SIZE = 1 << 20
+# Number of bytes read from the start of an input to identify its type
+SNIFF_SIZE = 16
+# Only files starting with the header are taken for PDFs, the others go through OpenOffice
+PDF_MAGIC = b'%PDF-'
+# Images that are converted to PDF without OpenOffice
+IMAGE_MAGIC = (
+  (b'\x89PNG\r\n\x1a\n', 'PNG'),
+  (b'\xff\xd8\xff', 'JPEG'),
+  (b'GIF87a', 'GIF'),
+  (b'GIF89a', 'GIF'),
+  (b'II*\x00', 'TIFF'),
+  (b'MM\x00*', 'TIFF'),
+  )
+# Prints the MediaBox and rotation of every page, one page per line
+PDF_PAGESIZES_PROGRAM = '1 1 pdfpagecount { pdfgetpage dup (DOCSTRUCT-PAGE ) print /MediaBox pget not { [0 0 612 792] } if ==only ( ) print /Rotate pget not { 0 } if = } for'
+PDF_PAGESIZES_REGEX = re.compile(r'^DOCSTRUCT-PAGE \[([^\]]*)\] (-?[\d.]+)', re.MULTILINE)
+
+
+def ThumbnailOrder(Thumbnail):
+  """Sort key keeping thumbnails in page order, the regular one first"""
+  sizes = ['{0}x{1}'.format(w, h) for w, h in THUMBNAIL_SIZES]
+  return (Thumbnail['PageNumber'], sizes.index(Thumbnail['Key'].split('.')[-2]))
+
+
+def MissingPageRanges(*, FirstPage, LastPage, Rendered):
+  """Get the runs of consecutive pages of a range that have not been rendered yet
+
+  :param Rendered: Numbers of the pages already rendered
+  :type Rendered: set
+  :return: List of [first page, last page]
+  :rtype: list
+  """
+  ranges = []
+  for page_num in range(FirstPage, LastPage + 1):
+    if page_num in Rendered:
+      continue
+    if ranges and ranges[-1][1] == page_num - 1:
+      ranges[-1][1] = page_num
+    else:
+      ranges.append([page_num, page_num])
+  return ranges
+
+
+class ConverterUnavailableException(Exception):
+  """This exception signifies that no office could be reached to convert the document"""
+  pass
+
+
+class ConversionFailedException(Exception):
+  """This exception signifies that the converter service answered, and only this document failed"""
+  pass
+
+
+class CircuitBreaker():
+  """Stops sending conversions to the converter once it keeps failing to reach an office
+
+  The breaker opens after FailureThreshold consecutive failures. After ResetTimeout seconds
+  a single call is let through, its success closes the breaker and its failure opens it again.
+  """
+
+  CLOSED = 'CLOSED'
+  OPEN = 'OPEN'
+  HALF_OPEN = 'HALF_OPEN'
+
+  def __init__(self, *, FailureThreshold=BREAKER_FAILURE_THRESHOLD, ResetTimeout=BREAKER_RESET_TIMEOUT):
+    self.FailureThreshold = FailureThreshold
+    self.ResetTimeout = ResetTimeout
+    self.State = self.CLOSED
+    self.NumFailures = 0
+    self.OpenedAt = 0
+    self.Lock = threading.Lock()
+
+  def Allow(self):
+    with self.Lock:
+      if self.State == self.OPEN and time.time() - self.OpenedAt >= self.ResetTimeout:
+        # Probe with this call, the others keep waiting for its result
+        self.State = self.HALF_OPEN
+        return True
+      return self.State == self.CLOSED
+
+  def RecordSuccess(self):
+    with self.Lock:
+      self.State = self.CLOSED
+      self.NumFailures = 0
+
+  def RecordFailure(self):
+    with self.Lock:
+      self.NumFailures += 1
+      if self.State == self.HALF_OPEN or self.NumFailures >= self.FailureThreshold:
+        self.State = self.OPEN
+        self.OpenedAt = time.time()
+
+
+# Breakers of the converter services of this host, by socket path
+BREAKERS = {}
+
+
+class DocumentConverterClient():
+  """Sends conversion requests to the long lived document converter service of this host
+
+  The service keeps its connection to the headless openoffice server open, so a
+  conversion costs a single request instead of a python2 start and a UNO handshake.
+  It is started on first use if it is not running yet, and restarted if it died.
+  """
+
+  # Version of the office and of the export filters, found once per jobs processor
+  _Version = None
+
+  def __init__(self, *, SocketPath=CONVERTER_SOCKET_PATH, PoolSize=None, MaxConversions=None, ConversionTimeout=None, BreakerFailureThreshold=None, BreakerResetTimeout=None, PostponeDelay=None):
+    self.SocketPath = SocketPath
+    # One office per jobs processor on the host, up to the number of cores, unless configured otherwise
+    self.PoolSize = PoolSize or min(Governor.NumConcurrentJobs, Governor.NumCores)
+    self.MaxConversions = MaxConversions
+    self.ConversionTimeout = ConversionTimeout
+    self.PostponeDelay = PostponeDelay or BREAKER_POSTPONE_DELAY
+    # The breaker outlives the client, it is shared by every job of this jobs processor
+    if SocketPath not in BREAKERS:
+      BREAKERS[SocketPath] = CircuitBreaker(
+        FailureThreshold=BreakerFailureThreshold or BREAKER_FAILURE_THRESHOLD,
+        ResetTimeout=BreakerResetTimeout or BREAKER_RESET_TIMEOUT,
+        )
+    self.Breaker = BREAKERS[SocketPath]
+
+  @property
+  def Version(self):
+    """Version of the office the service converts with and hash of the converter, which holds the filter settings
+
+    :return: The version, or an empty string when the service cannot tell
+    :rtype: str
+    """
+    if type(self)._Version is None:
+      try:
+        response = self.Request({'version': True}, Timeout=CONVERTER_CHECK_TIMEOUT)
+      except Exception:
+        # Ask again on the next use rather than turning off the cache for good
+        return ''
+      type(self)._Version = response['version']
+    return self._Version
+
+  @classmethod
+  def FromConfig(cls, Config):
+    """Get a client for the converter service configured under the "Document" section"""
+    return cls(
+      SocketPath=Config.Document_ConverterSocketPath or CONVERTER_SOCKET_PATH,
+      PoolSize=Config.Document_PoolSize,
+      MaxConversions=Config.Document_MaxConversions,
+      ConversionTimeout=Config.Document_ConversionTimeout,
+      BreakerFailureThreshold=Config.Document_BreakerFailureThreshold,
+      BreakerResetTimeout=Config.Document_BreakerResetTimeout,
+      PostponeDelay=Config.Document_PostponeDelay,
+      )
+
+  def Connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.SocketPath)
+    except OSError:
+      sock.close()
+      raise
+    return sock
+
+  def StartService(self):
+    # NOTE: the service gets its own session so that it outlives this jobs processor,
+    #       and it is not governed since it is shared by every jobs processor on the host.
+    cmd = [Binaries.Python2, Binaries.DocumentConverter, '--serve', self.SocketPath, '--pool-size', str(self.PoolSize)]
+    if self.MaxConversions:
+      cmd.extend(('--max-conversions', str(self.MaxConversions)))
+    if self.ConversionTimeout:
+      cmd.extend(('--timeout', str(self.ConversionTimeout)))
+    subprocess.Popen(
+      cmd,
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+      start_new_session=True,
+      )
+    deadline = time.time() + CONVERTER_STARTUP_TIMEOUT
+    while time.time() < deadline:
+      try:
+        return self.Connect()
+      except OSError:
+        time.sleep(0.5)
+    raise ConverterUnavailableException("ERROR: the document converter service did not start listening on {0}".format(self.SocketPath))
+
+  def Request(self, Request, Timeout=None):
+    # A job already past its deadline stops here, the socket below never gets a timeout of 0,
+    # which would make it non-blocking rather than time out
+    if Timeout is None:
+      Governor.CheckDeadline()
+    try:
+      sock = self.Connect()
+    except OSError:
+      sock = self.StartService()
+    # The service has a watchdog of its own, but the job must not wait past its deadline
+    Remaining = Governor.RemainingTime
+    sock.settimeout(Timeout or (None if Remaining is None else max(Remaining, MIN_REQUEST_TIMEOUT)))
+    try:
+      with sock, sock.makefile('rwb') as fp:
+        fp.write(json.dumps(Request).encode('utf-8') + b'\n')
+        fp.flush()
+        line = fp.readline()
+    except socket.timeout:
+      raise JobTimeoutException("ERROR: the document converter service did not answer before the deadline of the job")
+    if not line:
+      raise Exception("ERROR: the document converter service closed the connection")
+    response = json.loads(line.decode('utf-8'))
+    if not response.get('ok'):
+      if re.search(r'failed to connect', response.get('error') or ''):
+        raise ConverterUnavailableException("ERROR: {0}".format(response.get('error')))
+      raise ConversionFailedException("ERROR: {0}".format(response.get('error')))
+    return response
+
+  def Check(self):
+    """Make sure the service runs and one of its offices accepts conversions, starting them if needed
+
+    :raises ConverterUnavailableException: when no office can be reached
+    """
+    try:
+      self.Request({'check': True}, Timeout=CONVERTER_CHECK_TIMEOUT)
+    except JobTimeoutException:
+      raise ConverterUnavailableException("ERROR: the document converter service did not answer within {0} seconds".format(CONVERTER_CHECK_TIMEOUT))
+
+  def Convert(self, *, InputFilePath, OutputFilePaths):
+    """Convert a document to every output, the format of each is given by its extension
+
+    While no office can be reached, the job is postponed instead of failing.
+    """
+    if not self.Breaker.Allow():
+      raise PostponeJobException("no office is available to convert documents", Delay=self.PostponeDelay)
+    try:
+      response = self.Request({'input': InputFilePath, 'outputs': list(OutputFilePaths)})
+    except ConverterUnavailableException as exc:
+      self.Breaker.RecordFailure()
+      raise PostponeJobException(str(exc), Delay=self.PostponeDelay)
+    except (ConversionFailedException, JobTimeoutException):
+      # An office answered, only this document failed. That includes documents that overran
+      # the deadline of the job, which says nothing about the other documents.
+      self.Breaker.RecordSuccess()
+      raise
+    except Exception:
+      # EX: the service crashed and dropped the connection, or answered garbage
+      self.Breaker.RecordFailure()
+      raise
+    self.Breaker.RecordSuccess()
+    return response
 
 
 class S3BackedDocument(S3BackedFile):
 
-  def __init__(self, *, OutputKey, **kw):
+  def __init__(self, *, OutputKey, ExtraOutputs=(), DirectRender=True, SpritePages=None, EagerPages=None, OptimizePDF=None, ExtractText=None, CacheConversions=None, **kw):
     super().__init__(**kw)
     self.OutputKey = OutputKey
+    # (output key, format) of the other formats exported along with the PDF
+    self.ExtraOutputs = ExtraOutputs
+    self.DirectRender = DirectRender
+    # Number of pages of which the small thumbnails are packed in a sprite sheet, 0 uploads them one by one
+    self.SpritePages = (self.Config.Document_SpritePages or 0) if SpritePages is None else SpritePages
+    # Number of pages rendered by the conversion, the others are rendered on demand. 0 renders every page.
+    self.EagerPages = (self.Config.Document_EagerPages or 0) if EagerPages is None else EagerPages
+    # Linearize the PDF, downsample its images and subset its fonts before uploading it
+    self.OptimizePDF = bool(self.Config.Document_OptimizePDF) if OptimizePDF is None else OptimizePDF
+    # Upload the text of every page along with the thumbnails, for the search indexer
+    self.ExtractText = bool(self.Config.Document_ExtractText) if ExtractText is None else ExtractText
+    # Reuse the conversions of identical inputs made by the same version of the converter
+    self.CacheConversions = bool(self.Config.Document_CacheConversions) if CacheConversions is None else CacheConversions
+    self._CacheKey = None
+    self._InputDigest = None
+    self.Converter = DocumentConverterClient.FromConfig(self.Config)
 
-  def GenerateImagesFromPDF(self, *, PDFPath):
-    # Generate images from pages of PDF and save images to S3
-    PageNamePrefix = PDFPath.replace('.pdf', '')
-    PageNameFormat = PageNamePrefix + '-%d.png'
+  def GetLocalFilePathForExport(self, *, Key, Format):
+    # The converter picks the export filter from the extension of the file
+    if not Key.lower().endswith('.' + Format.lower()):
+      Key = '{0}.{1}'.format(Key, Format.lower())
+    return self.GetLocalFilePathFromS3Key(Key=Key, KeyPrefix=self.OutputKeyPrefix)
 
-    # Call ghostscript to produce the images
+  @property
+  def ConversionOutputFilePaths(self):
+    """Local paths of the PDF and of the other formats exported by the converter"""
+    return [self.GetLocalFilePathFromS3Key(Key=self.OutputKey, KeyPrefix=self.OutputKeyPrefix)] + [
+      self.GetLocalFilePathForExport(Key=key, Format=fmt) for key, fmt in self.ExtraOutputs
+      ]
+
+  def UploadExports(self):
+    """Upload the other formats exported by the converter and delete them right after"""
+    for key, fmt in self.ExtraOutputs:
+      FilePath = self.GetLocalFilePathForExport(Key=key, Format=fmt)
+      self.MarkFilePathForCleanup(FilePath)
+      o_key = os.path.join(self.OutputKeyPrefix, key)
+      with open(FilePath, 'rb') as fp:
+        S3.PutObject(
+          session=self.Config.Session,
+          bucket=self.Config.S3_OutputBucket,
+          key=o_key,
+          content=fp,
+          type_=mimetypes.guess_type(FilePath)[0] or "application/octet-stream",
+          )
+      os.remove(FilePath)
+      self.Output['Outputs'].append({'Key': o_key, 'Type': fmt.upper()})
+      self.Logger.debug("Finished Upload of {0} to S3".format(key))
+
+  @property
+  def CacheKey(self):
+    """Hash of the input and of the version of the converter, None when the version is unknown"""
+    if self._CacheKey is None:
+      Version = self.Config.Document_ConverterVersion or self.Converter.Version
+      # An unknown version is only asked for once per document
+      self._CacheKey = hashlib.sha256('{0} {1}'.format(self.InputDigest, Version).encode('utf-8')).hexdigest() if Version else ''
+    return self._CacheKey or None
+
+  @property
+  def PagesKey(self):
+    """Hash of the conversion and of the options the pages are rendered with, None when the version is unknown"""
+    if not self.CacheKey:
+      return None
+    options = json.dumps([self.DirectRender, self.SpritePages, self.OptimizePDF])
+    return hashlib.sha256('{0} {1}'.format(self.CacheKey, options).encode('utf-8')).hexdigest()
+
+  @property
+  def InputDigest(self):
+    """SHA-256 of the input document"""
+    if self._InputDigest is None:
+      digest = hashlib.sha256()
+      with open(self.LocalFilePath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+          digest.update(chunk)
+      self._InputDigest = digest.hexdigest()
+    return self._InputDigest
+
+  def CachedConversionKeys(self):
+    """Keys of the PDF and of the other formats in the conversion cache, along with their local paths"""
+    CacheKeyPrefix = self.Config.Document_CacheKeyPrefix or CACHE_KEY_PREFIX
+    return [
+      (os.path.join(CacheKeyPrefix, self.CacheKey + os.path.splitext(FilePath)[1]), FilePath)
+      for FilePath in self.ConversionOutputFilePaths
+      ]
+
+  def LoadCachedConversion(self):
+    """Get the PDF and the other formats from the conversion cache instead of converting
+
+    :return: True if every format was found in the cache
+    :rtype: bool
+    """
+    if not self.CacheConversions or not self.CacheKey:
+      return False
+    for key, FilePath in self.CachedConversionKeys():
+      content = S3.GetObject(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=key)
+      if content is None:
+        self.Logger.debug("{0} is not in the conversion cache".format(key))
+        return False
+      with open(FilePath, 'wb') as fp:
+        fp.write(content)
+    self.Output['Input']['CacheKey'] = self.CacheKey
+    self.Output['Input']['PagesKey'] = self.PagesKey
+    self.Logger.debug("Found the conversion of {0} in the cache".format(self.InputKey))
+    return True
+
+  def StoreCachedConversion(self):
+    """Save the PDF and the other formats in the conversion cache"""
+    if not self.CacheConversions or not self.CacheKey:
+      return
+    for key, FilePath in self.CachedConversionKeys():
+      with open(FilePath, 'rb') as fp:
+        S3.PutObject(
+          session=self.Config.Session,
+          bucket=self.Config.S3_OutputBucket,
+          key=key,
+          content=fp,
+          type_=mimetypes.guess_type(FilePath)[0] or "application/octet-stream",
+          )
+    self.Output['Input']['CacheKey'] = self.CacheKey
+    self.Output['Input']['PagesKey'] = self.PagesKey
+    self.Logger.debug("Saved the conversion of {0} in the cache".format(self.InputKey))
+
+  def LoadPreviousPages(self):
+    """Get the pages rendered from the same conversion with the same options by a previous run, EX: before a retrigger
+
+    :return: Thumbnails of the pages in page order
+    :rtype: list
+    """
+    output, thumbs = self.LoadRenderedPages()
+    if not self.PagesKey or not output or output['state'] != 'COMPLETED' or output['Input'].get('PagesKey') != self.PagesKey:
+      return []
+    return thumbs
+
+  def Sniff(self, FilePath):
+    """Identify the inputs that do not need OpenOffice from their first bytes
+
+    :return: 'PDF', the type of an image or None for anything else
+    :rtype: str
+    """
+    with open(FilePath, 'rb') as fp:
+      head = fp.read(SNIFF_SIZE)
+    for magic, ftype in IMAGE_MAGIC:
+      if head.startswith(magic):
+        return ftype
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+      return 'WEBP'
+    if head.startswith(PDF_MAGIC):
+      return 'PDF'
+    return None
+
+  def ConvertImageToPDF(self, *, InputFilePath, OutputFilePath, ImageType):
+    """Wrap an image that was uploaded as a document in a PDF
+
+    The image goes through the same header checks as the image jobs before anything decodes it.
+    """
+    # Every page of a TIFF is a page of the document, other images only have their first frame kept
+    AllFrames = ImageType == 'TIFF'
+    self.Preflight(InputFilePath, AllFrames=AllFrames)
+    source = InputFilePath if AllFrames else '{0}[0]'.format(InputFilePath)
     try:
-      out = subprocess.check_output((self.Binaries.Ghostscript, '-sDEVICE=png256', '-dNOPAUSE', '-r300', '-o', PageNameFormat, PDFPath), stderr=subprocess.STDOUT)
+      cmd = (
+        self.Binaries.Convert,
+        *self.DecodeOptions,
+        source,
+        '-auto-orient',
+        OutputFilePath,
+        )
+      self.Governor.CheckOutput(cmd)
     except subprocess.CalledProcessError as exc:
       raise Exception("ERROR: {0}".format(exc.output))
 
-    # search for all files with the relevant prefix and upload them to S3
-    images = glob.glob(PageNamePrefix + '-*.png')
-    regex = re.compile(PageNamePrefix + '-(\d+)\.png')
-    images.sort(key=lambda im: int(regex.sub('\g<1>', im)))
-    thumbs = []
+  def Optimize(self, PDFPath):
+    """Rewrite the PDF for the web in place, unless that does not make it smaller
+
+    ghostscript linearizes the PDF so that viewers can show the first page before the
+    rest is downloaded, downsamples its images and only embeds the glyphs that are used.
 
-    # Loop over the images of pages to create thumbnails from them
-    for im in images:
+    :return: Sizes in bytes before and after, and bytes saved
+    :rtype: dict
+    """
+    Resolution = self.Config.Document_OptimizeResolution or OPTIMIZE_RESOLUTION
+    OptimizedPath = '{0}.optimized.pdf'.format(PDFPath)
+    self.MarkFilePathForCleanup(OptimizedPath)
+    OriginalSize = os.path.getsize(PDFPath)
+    try:
+      self.Governor.CheckOutput((
+        self.Binaries.Ghostscript,
+        '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER',
+        '-sDEVICE=pdfwrite',
+        '-dCompatibilityLevel=1.5',
+        '-dFastWebView=true',
+        '-dEmbedAllFonts=true',
+        '-dSubsetFonts=true',
+        '-dCompressFonts=true',
+        '-dDetectDuplicateImages=true',
+        '-dDownsampleColorImages=true',
+        '-dColorImageDownsampleType=/Bicubic',
+        '-dColorImageResolution={0}'.format(Resolution),
+        '-dDownsampleGrayImages=true',
+        '-dGrayImageDownsampleType=/Bicubic',
+        '-dGrayImageResolution={0}'.format(Resolution),
+        '-dDownsampleMonoImages=true',
+        '-dMonoImageResolution={0}'.format(Resolution * 2),
+        '-sOutputFile={0}'.format(OptimizedPath),
+        PDFPath,
+        ))
+    except subprocess.CalledProcessError as exc:
+      # The PDF is still usable as it is
+      self.Logger.warning("Could not optimize the PDF of {0}: {1}".format(self.InputKey, exc.output))
+      return {'OriginalSize': OriginalSize, 'OptimizedSize': OriginalSize, 'BytesSaved': 0}
+    OptimizedSize = os.path.getsize(OptimizedPath)
+    if OptimizedSize < OriginalSize:
+      os.replace(OptimizedPath, PDFPath)
+    else:
+      os.remove(OptimizedPath)
+      OptimizedSize = OriginalSize
+    self.Logger.debug("Optimized the PDF of {0} from {1} to {2} bytes".format(self.InputKey, OriginalSize, OptimizedSize))
+    return {'OriginalSize': OriginalSize, 'OptimizedSize': OptimizedSize, 'BytesSaved': OriginalSize - OptimizedSize}
 
-      # Prepare filenames
-      regular_thumnail_file = im.replace('.png', '.1200x1200.png')
-      small_thumbnail_file = im.replace('.png', '.160x160.png')
-      page_num = int(regex.sub('\g<1>', im))
+  def ExtractPageText(self, PDFPath):
+    """Extract the text of every page of the PDF and upload it as gzipped JSON
 
-      # Now, upload the 2 thumbnails to S3
-      for fname in (regular_thumnail_file, small_thumbnail_file):
-        # Get the size specification from the filename.
-        # EX: if fname == thumb-1.1200x1200.png, fsize = 1200x1200
-        fsize = fname.split('.')[-2]
-        # Create regular version
+    EX: {"Pages": [{"PageNumber": 1, "Text": "..."}, ...]}
+
+    :return: Key of the text and number of pages
+    :rtype: dict
+    """
+    TextNamePrefix = '{0}-text'.format(PDFPath.replace('.pdf', ''))
+    try:
+      self.Governor.CheckOutput((
+        self.Binaries.Ghostscript,
+        '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER',
+        '-sDEVICE=txtwrite',
+        '-sOutputFile={0}-%d.txt'.format(TextNamePrefix),
+        PDFPath,
+        ))
+    except subprocess.CalledProcessError as exc:
+      raise Exception("ERROR: {0}".format(exc.output))
+    # ghostscript writes a file per page, numbered from 1
+    pages = []
+    regex = re.compile(re.escape(TextNamePrefix) + r'-(\d+)\.txt')
+    for fname in glob.glob(glob.escape(TextNamePrefix) + '-*.txt'):
+      self.MarkFilePathForCleanup(fname)
+      with open(fname, encoding='utf-8', errors='replace') as fp:
+        pages.append({'PageNumber': int(regex.sub(r'\g<1>', fname)), 'Text': fp.read()})
+      os.remove(fname)
+    pages.sort(key=lambda page: page['PageNumber'])
+    o_key = os.path.join(self.OutputKeyPrefix, TEXT_KEY)
+    S3.PutObject(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=o_key,
+      content=gzip.compress(json.dumps({'Pages': pages}, separators=(',', ':')).encode('utf-8')),
+      type_='application/gzip',
+      )
+    self.Logger.debug("Finished Upload of the text of {0} to S3".format(self.InputKey))
+    return {'Key': o_key, 'NumPages': len(pages)}
+
+  def RunPostScript(self, *, PDFPath, Program):
+    """Run a PostScript program against an opened PDF without rendering anything"""
+    # Escape the path so that it can be used as a PostScript string
+    pspath = PDFPath.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    try:
+      out = self.Governor.CheckOutput((
+        self.Binaries.Ghostscript,
+        '-q', '-dNODISPLAY', '-dSAFER', '-dNOPAUSE', '-dBATCH',
+        # The program opens the PDF itself, which SAFER only allows for this one file
+        '--permit-file-read={0}'.format(PDFPath),
+        '-c', '({0}) (r) file runpdfbegin {1} quit'.format(pspath, Program),
+        ))
+    except subprocess.CalledProcessError as exc:
+      raise Exception("ERROR: {0}".format(exc.output))
+    return out.decode('utf-8', 'replace')
+
+  def CountPDFPages(self, PDFPath):
+    """Ask ghostscript for the number of pages without rendering any of them"""
+    out = self.RunPostScript(PDFPath=PDFPath, Program='pdfpagecount =')
+    return int(out.split()[-1])
+
+  def InspectPDF(self, PDFPath):
+    """Get the size in points of every page of the PDF, as it is displayed
+
+    :return: List of (width, height) ordered by page
+    :rtype: list
+    """
+    out = self.RunPostScript(PDFPath=PDFPath, Program=PDF_PAGESIZES_PROGRAM)
+    pages = []
+    for m in PDF_PAGESIZES_REGEX.finditer(out):
+      x0, y0, x1, y1 = (float(v) for v in m.group(1).split())
+      width, height = abs(x1 - x0), abs(y1 - y0)
+      # Pages rotated sideways are displayed with their sides swapped
+      if int(float(m.group(2))) % 180:
+        width, height = height, width
+      pages.append((width, height))
+    return pages
+
+  def PlanRasterization(self, *, PDFPath, NumProcesses, FirstPage=1, LastPage=None):
+    """Split the pages in ranges that are each rendered by a single ghostscript process
+
+    Ranges are kept short so that the first pages are done while the rest is still
+    rendering. When rendering directly at the size of the regular thumbnail, pages
+    of a range also share the resolution that size requires.
+
+    :return: List of (first page, last page, resolution)
+    :rtype: list
+    """
+    if self.DirectRender:
+      MaxWidth, MaxHeight = THUMBNAIL_SIZES[0]
+      # Resolution at which each page fits in the regular thumbnail
+      resolutions = [
+        math.floor(min(MaxWidth * 72 / w, MaxHeight * 72 / h) * 100) / 100 if w and h else RASTERIZE_RESOLUTION
+        for w, h in self.InspectPDF(PDFPath)
+        ]
+    else:
+      resolutions = [RASTERIZE_RESOLUTION] * self.CountPDFPages(PDFPath)
+    # Only plan the requested pages
+    resolutions = resolutions[FirstPage - 1:LastPage]
+    NumPages = len(resolutions)
+    ChunkSize = max(1, min(RASTERIZE_CHUNK_SIZE, math.ceil(NumPages / NumProcesses)))
+    chunks = []
+    for page_num, resolution in enumerate(resolutions, FirstPage):
+      if chunks and chunks[-1][2] == resolution and page_num - chunks[-1][0] < ChunkSize:
+        chunks[-1][1] = page_num
+      else:
+        chunks.append([page_num, page_num, resolution])
+    return [tuple(c) for c in chunks]
+
+  def RasterizePages(self, *, PDFPath, FirstPage, LastPage, Resolution, NumProcesses=1):
+    """Render a range of pages of the PDF to png files named after their page
+
+    :param NumProcesses: Number of ranges rendered at once, which share the resources of the job
+    :return: List of (page number, image path) for the rendered pages
+    :rtype: list
+    """
+    PageNamePrefix = PDFPath.replace('.pdf', '')
+    ChunkNamePrefix = '{0}-{1}to{2}'.format(PageNamePrefix, FirstPage, LastPage)
+    if self.DirectRender:
+      # Render straight to the regular thumbnail, anti-aliased since nothing resamples it
+      options = ('-sDEVICE=png16m', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4')
+      PageNameFormat = '{0}-{1}.{2}x{3}.png'
+    else:
+      options = ('-sDEVICE=png256',)
+      PageNameFormat = '{0}-{1}.png'
+    # Call ghostscript to produce the images
+    try:
+      out = self.Governor.CheckOutput((
+        self.Binaries.Ghostscript,
+        *options,
+        '-dNOPAUSE',
+        '-r{0}'.format(Resolution),
+        '-dFirstPage={0}'.format(FirstPage),
+        '-dLastPage={0}'.format(LastPage),
+        '-o', ChunkNamePrefix + '-%d.png',
+        PDFPath,
+        ), NumProcesses=NumProcesses)
+    except subprocess.CalledProcessError as exc:
+      raise Exception("ERROR: {0}".format(exc.output))
+    # ghostscript numbers the files of every run from 1, name them after their page instead
+    pages = []
+    regex = re.compile(re.escape(ChunkNamePrefix) + r'-(\d+)\.png')
+    for im in glob.glob(glob.escape(ChunkNamePrefix) + '-*.png'):
+      page_num = FirstPage + int(regex.sub(r'\g<1>', im)) - 1
+      fname = PageNameFormat.format(PageNamePrefix, page_num, *THUMBNAIL_SIZES[0])
+      os.rename(im, fname)
+      # Make sure the main file gets deleted after we exit
+      self.MarkFilePathForCleanup(fname)
+      pages.append((page_num, fname))
+    pages.sort()
+    return pages
+
+  def GenerateThumbnails(self, *, PageNumber, ImagePath, PageNamePrefix):
+    """Create the thumbnails of a rendered page
+
+    :return: Paths of the thumbnails, the regular one first
+    :rtype: list
+    """
+    # Prepare filenames
+    # EX: thumb-1.1200x1200.png, thumb-1.160x160.png
+    fnames = ['{0}-{1}.{2}x{3}.png'.format(PageNamePrefix, PageNumber, w, h) for w, h in THUMBNAIL_SIZES]
+    source = ImagePath
+    for fname in fnames:
+      # Get the size specification from the filename.
+      # EX: if fname == thumb-1.1200x1200.png, fsize = 1200x1200
+      fsize = fname.split('.')[-2]
+      # A page rendered at the size of the thumbnail is used as is
+      if fname != ImagePath:
         try:
           cmd = (
             self.Binaries.Convert,
-            im,
+            source,
             '-resize', fsize,
             fname,
             )
-          subprocess.call(cmd, stderr=subprocess.STDOUT)
+          self.Governor.CheckOutput(cmd)
         except subprocess.CalledProcessError as exc:
           raise Exception("ERROR: {0}".format(exc.output))
+        # Mark for cleanup
+        self.MarkFilePathForCleanup(fname)
+      # Smaller thumbnails are derived from the regular one rather than from the page
+      source = fnames[0]
+    # The page is not needed anymore once it has been resampled
+    if ImagePath not in fnames:
+      os.remove(ImagePath)
+    return fnames
 
-        # We'll upload using a stream
-        with open(fname, 'rb') as fp:
-          o_key = os.path.join(self.OutputKeyPrefix, fname.replace(PageNamePrefix, 'thumb'))
-          o_mime = mimetypes.guess_type(fname)[0] or "application/octet-stream"
-          S3.PutObject(
-            session=self.Config.Session,
-            bucket=self.Config.S3_OutputBucket,
-            key=o_key,
-            content=fp,
-            type_=o_mime,
-            )
+  def UploadThumbnail(self, *, PageNumber, FilePath, PageNamePrefix, Props=None):
+    """Upload a thumbnail to S3 and delete it right after
+
+    :param Props: Properties of the thumbnail when already inspected
+    """
+    # We'll upload using a stream
+    with open(FilePath, 'rb') as fp:
+      o_key = os.path.join(self.OutputKeyPrefix, FilePath.replace(PageNamePrefix, 'thumb'))
+      o_mime = mimetypes.guess_type(FilePath)[0] or "application/octet-stream"
+      S3.PutObject(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=o_key,
+        content=fp,
+        type_=o_mime,
+        )
 
-          # Log message saying that images has uploaded
-          self.Logger.debug("Finished Upload of {0} to S3".format(o_key))
+    # Log message saying that images has uploaded
+    self.Logger.debug("Finished Upload of {0} to S3".format(o_key))
 
-          # Inspect the path so that we get image props
-          props = self.InspectImage(fname)
-          props['Key'] = o_key
-          props['PageNumber'] = page_num
-          thumbs.append(props)
+    # Inspect the path so that we get image props, unless done already
+    props = self.InspectImage(FilePath) if Props is None else dict(Props)
+    props['Key'] = o_key
+    props['PageNumber'] = PageNumber
+    os.remove(FilePath)
+    return props
 
-          # Mark for cleanup
-          self.MarkFilePathForCleanup(fname)
+  def SpriteSheetRange(self, *, PageNumber, FirstPage, LastPage):
+    """Get the first and last page of the sprite sheet of a page, within the pages being rendered"""
+    first = (PageNumber - 1) // self.SpritePages * self.SpritePages + 1
+    return max(first, FirstPage), min(first + self.SpritePages - 1, LastPage)
 
-      # Make sure the main file gets deleted after we exit
-      self.MarkFilePathForCleanup(im)
+  def PackSpriteSheet(self, *, Pages, PageNamePrefix):
+    """Pack the thumbnails of consecutive pages in one image, upload it and delete the thumbnails
+
+    Thumbnails are laid out row by row in cells of the size of the thumbnail, the cell of
+    each page is recorded with the page.
+
+    :param Pages: (page number, thumbnail path, thumbnail props) ordered by page, all of the same size
+    :return: Properties of the thumbnail of every page
+    :rtype: list
+    """
+    fsize = Pages[0][1].split('.')[-2]
+    CellWidth, CellHeight = (int(v) for v in fsize.split('x'))
+    NumColumns = min(SPRITE_COLUMNS, len(Pages))
+    NumRows = math.ceil(len(Pages) / NumColumns)
+    SheetPath = '{0}-sprite-{1}to{2}.{3}.png'.format(PageNamePrefix, Pages[0][0], Pages[-1][0], fsize)
+    # Place every thumbnail in its cell of a transparent canvas
+    props = []
+    cmd = [self.Binaries.Convert, '-size', '{0}x{1}'.format(CellWidth * NumColumns, CellHeight * NumRows), 'xc:none']
+    for i, (page_num, fname, p) in enumerate(Pages):
+      p = dict(p)
+      p['PageNumber'] = page_num
+      p['SpriteX'] = i % NumColumns * CellWidth
+      p['SpriteY'] = i // NumColumns * CellHeight
+      props.append(p)
+      cmd.extend(('-page', '+{0}+{1}'.format(p['SpriteX'], p['SpriteY']), fname))
+    cmd.extend(('-layers', 'flatten', SheetPath))
+    try:
+      self.Governor.CheckOutput(cmd)
+    except subprocess.CalledProcessError as exc:
+      raise Exception("ERROR: {0}".format(exc.output))
+    self.MarkFilePathForCleanup(SheetPath)
+    for page_num, fname, p in Pages:
+      os.remove(fname)
+    # Every page refers to the sheet, whose own props are not recorded
+    o_key = self.UploadThumbnail(PageNumber=Pages[0][0], FilePath=SheetPath, PageNamePrefix=PageNamePrefix, Props={})['Key']
+    for p in props:
+      p['Key'] = o_key
+    return props
+
+  def GenerateImagesFromPDF(self, *, PDFPath, FirstPage=1, LastPage=None):
+    """Generate images from pages of PDF and save images to S3
+
+    Rendering, resizing and uploading run as concurrent stages connected by bounded
+    queues, so thumbnails of the first pages reach S3 while later pages still render
+    and no more than a few pages are on disk at any time.
+
+    The thumbnails of all the pages waiting to be resized are inspected by a single
+    identify. When sprite sheets are enabled, the small thumbnails are held back until
+    every page of their sheet is there.
+    """
+    PageNamePrefix = PDFPath.replace('.pdf', '')
+    # The regular thumbnail of the first page is published as the preview
+    PreviewSize = '{0}x{1}'.format(*THUMBNAIL_SIZES[0])
+    NumProcesses = self.Config.Document_MaxRasterizeProcesses or self.Governor.NumThreads
+    NumUploads = self.Config.Document_MaxUploads or MAX_PAGE_UPLOADS
+    rendered = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    resized = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # NOTE: once a stage fails, every stage keeps draining its queue without doing any
+    #       work so that nothing upstream stays blocked on a full queue.
+    errors = []
+    thumbs = []
+    # Small thumbnails waiting for the other pages of their sprite sheet, by (size, first page, last page)
+    sheets = {}
+    sheets_lock = threading.Lock()
+
+    def Render(FirstPage, LastPage, Resolution):
+      if errors:
+        return
+      try:
+        for page in self.RasterizePages(PDFPath=PDFPath, FirstPage=FirstPage, LastPage=LastPage, Resolution=Resolution, NumProcesses=NumProcesses):
+          rendered.put(page)
+      except Exception as exc:
+        errors.append(exc)
+
+    def Resize():
+      done = False
+      while not done:
+        # Take every page rendered so far, so that their thumbnails are inspected together
+        pages = [rendered.get()]
+        while pages[-1] is not None:
+          try:
+            pages.append(rendered.get_nowait())
+          except queue.Empty:
+            break
+        if pages[-1] is None:
+          done = True
+          pages.pop()
+        if errors or not pages:
+          continue
+        try:
+          fnames = [
+            (page_num, fname)
+            for page_num, im in pages
+            for fname in self.GenerateThumbnails(PageNumber=page_num, ImagePath=im, PageNamePrefix=PageNamePrefix)
+            ]
+          props = self.InspectImages([fname for page_num, fname in fnames])
+        except Exception as exc:
+          errors.append(exc)
+          continue
+        for (page_num, fname), p in zip(fnames, props):
+          resized.put((page_num, fname, p))
+      for i in range(NumUploads):
+        resized.put(None)
+
+    def Upload():
+      for page_num, fname, p in iter(resized.get, None):
+        if errors:
+          continue
+        fsize = fname.split('.')[-2]
+        pages = [(page_num, fname, p)]
+        if self.SpritePages and fsize != PreviewSize:
+          with sheets_lock:
+            sheet = (fsize,) + self.SpriteSheetRange(PageNumber=page_num, FirstPage=FirstPage, LastPage=LastPage)
+            sheets.setdefault(sheet, []).append((page_num, fname, p))
+            if len(sheets[sheet]) < sheet[2] - sheet[1] + 1:
+              continue
+            pages = sorted(sheets.pop(sheet), key=lambda page: page[0])
+        try:
+          if self.SpritePages and fsize != PreviewSize:
+            props = self.PackSpriteSheet(Pages=pages, PageNamePrefix=PageNamePrefix)
+          else:
+            props = [self.UploadThumbnail(PageNumber=page_num, FilePath=fname, PageNamePrefix=PageNamePrefix, Props=p)]
+        except Exception as exc:
+          errors.append(exc)
+          continue
+        # Make the thumbnails visible in the progress written to output.json
+        with self.OutputLock:
+          thumbs.extend(props)
+          self.Output['Outputs'].extend(props)
+          IsPreview = page_num == 1 and fsize == PreviewSize
+          if IsPreview:
+            self.Output['Preview'] = props[0]
+        self.PublishProgress(Force=IsPreview)
+
+    chunks = self.PlanRasterization(PDFPath=PDFPath, NumProcesses=NumProcesses, FirstPage=FirstPage, LastPage=LastPage)
+    if not chunks:
+      return []
+    LastPage = chunks[-1][1]
+    # Short documents do not keep every process busy, those running get a larger share
+    NumProcesses = min(NumProcesses, len(chunks))
+    workers = [threading.Thread(target=Resize)] + [threading.Thread(target=Upload) for i in range(NumUploads)]
+    for worker in workers:
+      worker.start()
+    # Render page ranges in parallel
+    try:
+      with ThreadPoolExecutor(max_workers=NumProcesses) as executor:
+        for first, last, resolution in chunks:
+          executor.submit(Render, first, last, resolution)
+    except BaseException as exc:
+      # EX: the watchdog stopped the job, the other stages must still wind down
+      errors.append(exc)
+      raise
+    finally:
+      rendered.put(None)
+      for worker in workers:
+        worker.join()
+    if errors:
+      raise errors[0]
+
+    # Keep the thumbnails in page order, the regular one first
+    thumbs.sort(key=ThumbnailOrder)
+    with self.OutputLock:
+      uploaded = {id(t) for t in thumbs}
+      self.Output['Outputs'] = [o for o in self.Output['Outputs'] if id(o) not in uploaded] + thumbs
 
     # Return all the keys that have been uploaded to S3
     return thumbs
 
-  def ConvertToPDF(self):
+  def ShardKey(self, Name):
+    return os.path.join(self.OutputKeyPrefix, SHARDS_KEY_PREFIX, Name)
+
+  def ShardResultKey(self, *, FirstPage, LastPage):
+    return self.ShardKey('{0}-{1}.json'.format(FirstPage, LastPage))
+
+  def PlanShards(self, NumPages):
+    """Split long documents in page ranges, only when there is a queue to share them through
+
+    :return: List of (first page, last page), empty when the document is not split
+    :rtype: list
+    """
+    ShardPages = self.Config.Document_ShardPages or SHARD_PAGES
+    if NumPages <= ShardPages or not self.Config.SQS_QueueUrl:
+      return []
+    return [(first, min(first + ShardPages - 1, NumPages)) for first in range(1, NumPages + 1, ShardPages)]
+
+  def StartShards(self, Shards):
+    """Record the page ranges in the manifest and hand all of them but the first to the other workers
+
+    A retry of the first page range finds the manifest of the previous attempt and does not
+    hand out the other ranges again.
+    """
+    ManifestKey = self.ShardKey('manifest.json')
+    # What the page ranges are rendered from, a manifest left by another input or other options is replaced
+    Source = {
+      'Digest': self.InputDigest,
+      'DirectRender': self.DirectRender,
+      'SpritePages': self.SpritePages,
+      }
+    manifest = S3.GetJSON(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=ManifestKey)
+    # output.json is written by the page range that finishes last
+    self.Deferred = True
+    if manifest and manifest['Shards'] == [list(s) for s in Shards] and manifest.get('Source') == Source:
+      self.Logger.debug("The page ranges of {0} have already been handed out".format(self.InputKey))
+      return
+    # Results left by a previous split must not be merged with this one
+    for first, last in Shards:
+      S3.PutJSON(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=self.ShardResultKey(FirstPage=first, LastPage=last),
+        content={'state': 'PROGRESSING'},
+        )
+    S3.PutJSON(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=ManifestKey,
+      content={'Shards': Shards, 'Source': Source, 'Output': self.Output},
+      )
+    for first, last in Shards[1:]:
+      job = RenderPagesJob(
+        InputKey=self.InputKey,
+        OutputKeyPrefix=self.OutputKeyPrefix,
+        OutputKey=self.OutputKey,
+        FirstPage=first,
+        LastPage=last,
+        DirectRender=self.DirectRender,
+        SpritePages=self.SpritePages,
+        Shard=True,
+        )
+      SQS.PostMessage(self.Config.Session, self.Config.SQS_QueueUrl, job.ToJSON())
+    self.Logger.debug("Split {0} in {1} page ranges".format(self.InputKey, len(Shards)))
+
+  def MergeShards(self):
+    """Write the output.json of the whole document once every page range has a result
+
+    Every page range tries this after recording its result, whichever sees all of them
+    merges the thumbnails in page order.
+
+    :return: True if output.json has been written
+    :rtype: bool
+    """
+    manifest = S3.GetJSON(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=self.ShardKey('manifest.json'))
+    if not manifest:
+      return False
+    results = [
+      S3.GetJSON(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=self.ShardResultKey(FirstPage=first, LastPage=last))
+      for first, last in manifest['Shards']
+      ]
+    if any(not r or r['state'] == 'PROGRESSING' for r in results):
+      return False
+    output = manifest['Output']
+    errors = [r['Error'] for r in results if r['state'] == 'ERROR']
+    if errors:
+      output['state'] = 'ERROR'
+      output['Error'] = errors[0]
+    else:
+      output['state'] = 'COMPLETED'
+      output['Outputs'].extend(sorted((t for r in results for t in r['Outputs']), key=ThumbnailOrder))
+      # The text and the preview come from the first page range
+      for r in results:
+        if r.get('Text'):
+          output['Text'] = r['Text']
+        if r.get('Preview'):
+          output['Preview'] = r['Preview']
+    S3.PutJSON(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=os.path.join(self.OutputKeyPrefix, "output.json"),
+      content=output,
+      )
+    self.Logger.debug("Merged the page ranges of {0}".format(self.InputKey))
+    return True
+
+  def PagesResultKey(self, *, FirstPage, LastPage):
+    return os.path.join(self.OutputKeyPrefix, PAGES_KEY_PREFIX, '{0}-{1}.json'.format(FirstPage, LastPage))
+
+  def LoadPagesResults(self):
+    """Get the results of the ranges rendered on demand that are completed
+
+    :return: Results by key
+    :rtype: dict
+    """
+    results = {}
+    for obj in S3.ListKeysInBucket(session=self.Config.Session, bucketname=self.Config.S3_OutputBucket, prefix=os.path.join(self.OutputKeyPrefix, PAGES_KEY_PREFIX, '')):
+      result = S3.GetJSON(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=obj.key)
+      if result and result['state'] == 'COMPLETED':
+        results[obj.key] = result
+    return results
+
+  def LoadRenderedPages(self, Results=None):
+    """Get the output.json of the document along with every page rendered so far
+
+    :param Results: Results of the ranges rendered on demand, as returned by LoadPagesResults
+    :return: (output.json, thumbnails of the pages in page order), output.json is None until written
+    :rtype: tuple
+    """
+    output = S3.GetJSON(session=self.Config.Session, bucket=self.Config.S3_OutputBucket, key=os.path.join(self.OutputKeyPrefix, "output.json"))
+    if not output:
+      return None, []
+    thumbs = {(o['PageNumber'], o['Key'].split('.')[-2]): o for o in output['Outputs'] if 'PageNumber' in o}
+    # Add the pages of the ranges rendered on demand, whether merged already or not
+    if Results is None:
+      Results = self.LoadPagesResults()
+    for result in Results.values():
+      for t in result['Outputs']:
+        thumbs.setdefault((t['PageNumber'], t['Key'].split('.')[-2]), t)
+    return output, sorted(thumbs.values(), key=ThumbnailOrder)
+
+  def MergePages(self):
+    """Add the pages rendered on demand to output.json
+
+    Every range rendered on demand records its pages in a file of its own and the whole
+    set is merged each time. S3 has no conditional writes, so a range that completed while
+    output.json was being written may have merged before this write landed. The results are
+    listed again afterwards and the merge is repeated until no new range shows up, the last
+    write then holds every range.
+
+    :return: True if output.json has been written
+    :rtype: bool
+    """
+    results = self.LoadPagesResults()
+    while True:
+      output, thumbs = self.LoadRenderedPages(Results=results)
+      if not output or output['state'] != 'COMPLETED':
+        return False
+      output['Outputs'] = [o for o in output['Outputs'] if 'PageNumber' not in o] + thumbs
+      S3.PutJSON(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=os.path.join(self.OutputKeyPrefix, "output.json"),
+        content=output,
+        )
+      latest = self.LoadPagesResults()
+      if latest.keys() <= results.keys():
+        break
+      results = latest
+    self.Logger.debug("Merged the pages rendered on demand of {0}".format(self.InputKey))
+    return True
+
+  def RenderPages(self, *, FirstPage, LastPage, OnDemand=False):
+    """Render the thumbnails of a range of pages of a document already converted to PDF
+
+    On demand, pages that have already been rendered are skipped. A request that comes in
+    while the document is still being converted is postponed until the conversion is done.
+    """
+    if OnDemand:
+      output, thumbs = self.LoadRenderedPages()
+      if output and output['state'] == 'ERROR':
+        raise NoMoreRetriesException("ERROR: {0} could not be converted: {1}".format(self.InputKey, output.get('Error')))
+      if not output or output['state'] != 'COMPLETED':
+        raise PostponeJobException(
+          "{0} is still being converted".format(self.InputKey),
+          Delay=self.Config.Document_PagesPostponeDelay or PAGES_POSTPONE_DELAY,
+          )
+      LastPage = min(LastPage, output['Input']['NumPages'])
+      # Only render the runs of consecutive pages that are missing
+      ranges = MissingPageRanges(FirstPage=FirstPage, LastPage=LastPage, Rendered={t['PageNumber'] for t in thumbs})
+      if not ranges:
+        self.Logger.debug("Pages {0} to {1} of {2} are already rendered".format(FirstPage, LastPage, self.InputKey))
+        return
+      FirstPage, LastPage = ranges[0][0], ranges[-1][1]
+    else:
+      ranges = [[FirstPage, LastPage]]
+    # Several ranges of the same document may be rendered on this host, each gets its own copy
+    PDFPath = self.GetLocalFilePathFromS3Key(Key='pages-{0}-{1}.pdf'.format(FirstPage, LastPage), KeyPrefix=self.OutputKeyPrefix)
+    content = S3.GetObject(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=os.path.join(self.OutputKeyPrefix, self.OutputKey),
+      )
+    if content is None:
+      raise Exception("ERROR: {0} has not been converted to PDF".format(self.InputKey))
+    with open(PDFPath, 'wb') as fp:
+      fp.write(content)
+    self.MarkFilePathForCleanup(PDFPath)
+    for first, last in ranges:
+      self.GenerateImagesFromPDF(PDFPath=PDFPath, FirstPage=first, LastPage=last)
+
+  def ConvertToPDF(self, Converted=False, Cached=False):
+    """Convert the document to PDF, upload it and render its pages
+
+    :param Converted: True if the converter already produced the PDF and the other formats
+    :type Converted: bool
+    :param Cached: True if LoadCachedConversion already got them from the conversion cache
+    :type Cached: bool
+    """
     # Prepare some variables we need for this job
     FilePath = self.LocalFilePath
     OutputFilePath = self.GetLocalFilePathFromS3Key(Key=self.OutputKey, KeyPrefix=self.OutputKeyPrefix)
-    self.Logger.debug("Will convert {0} to {1}".format(self.InputKey, self.OutputKey))
-
-    # Use pyuno to speak to the headless openoffice server
-    try:
-      out = subprocess.check_output((self.Binaries.Python2, self.Binaries.DocumentConverter, FilePath, OutputFilePath), stderr=subprocess.STDOUT)
-      self.Logger.debug("Done with conversion")
-    except subprocess.CalledProcessError as exc:
-      raise Exception("ERROR: {0}".format(exc.output))
-
-    # After conversion upload the file to S3
     o_key = os.path.join(self.OutputKeyPrefix, self.OutputKey)
     o_mime = mimetypes.guess_type(self.OutputKey)[0] or "application/octet-stream"
-    with open(OutputFilePath, 'rb') as fp:
-      S3.PutObject(
+    InputType = self.Sniff(FilePath)
+    # Thumbnails that a previous run rendered from the same conversion
+    Previous = []
+
+    if InputType == 'PDF' and not self.OptimizePDF:
+      # A PDF is already what we want, copy it within S3 and render its pages as is
+      self.Logger.debug("{0} is a PDF, copying it to {1}".format(self.InputKey, self.OutputKey))
+      S3.CopyObject(
         session=self.Config.Session,
+        source_bucket=self.Config.S3_InputBucket,
+        source_key=self.InputKey,
         bucket=self.Config.S3_OutputBucket,
         key=o_key,
-        content=fp,
         type_=o_mime,
         )
+      OutputFilePath = FilePath
+      self.Logger.debug("Finished Copy of {0} in S3".format(self.OutputKey))
+    else:
+      self.Logger.debug("Will convert {0} to {1}".format(self.InputKey, self.OutputKey))
+      if InputType == 'PDF':
+        # Only the optimization is needed
+        OutputFilePath = FilePath
+      elif InputType:
+        # Images mislabeled as documents are handled by imagemagick
+        self.ConvertImageToPDF(InputFilePath=FilePath, OutputFilePath=OutputFilePath, ImageType=InputType)
+      elif Cached or (not Converted and self.LoadCachedConversion()):
+        # The same document was converted by the same converter before, its pages may be there too
+        Previous = self.LoadPreviousPages()
+      else:
+        if not Converted:
+          # Let the converter service speak to the headless openoffice server, every format is
+          # exported from a single load of the document
+          self.Converter.Convert(InputFilePath=FilePath, OutputFilePaths=self.ConversionOutputFilePaths)
+        self.StoreCachedConversion()
+      self.Logger.debug("Done with conversion")
+      if self.OptimizePDF:
+        self.Output['Optimization'] = self.Optimize(OutputFilePath)
+
+      # After conversion upload the file to S3
+      with open(OutputFilePath, 'rb') as fp:
+        S3.PutObject(
+          session=self.Config.Session,
+          bucket=self.Config.S3_OutputBucket,
+          key=o_key,
+          content=fp,
+          type_=o_mime,
+          )
+      # Log a message
+      self.Logger.debug("Finished Upload of {0} to S3".format(self.OutputKey))
 
     # Save output key
     self.Output['Outputs'].append({'Key': o_key, 'Type': 'PDF'})
-    # Log a message
-    self.Logger.debug("Finished Upload of {0} to S3".format(self.OutputKey))
+    # The other formats follow the PDF, they are only exported from office documents
+    if InputType is None:
+      self.UploadExports()
+    elif self.ExtraOutputs:
+      self.Logger.info("{0} is not an office document, {1} will not be exported".format(self.InputKey, ', '.join(key for key, fmt in self.ExtraOutputs)))
+    # Add number of pages to Input
+    NumPages = self.CountPDFPages(OutputFilePath)
+    self.Output['Input']['NumPages'] = NumPages
+    # The PDF can be downloaded before the pages are rendered
+    self.PublishProgress(Force=True)
 
-    # Generate images from all pages of PDF
-    o_thumbs = self.GenerateImagesFromPDF(PDFPath=OutputFilePath)
-    self.Output['Outputs'].extend(o_thumbs)
-    # Add number of thumbnails to Input
-    # NOTE: we create 2 thumbnails per input, hence the division by 2
-    self.Output['Input'] = {'NumPages': (len(o_thumbs) / 2)}
+    # Long documents either get their first pages rendered and the others on demand, or are
+    # split and this worker renders the first range of pages
+    Shards = []
+    if self.EagerPages and NumPages > self.EagerPages:
+      FirstPage, LastPage = 1, self.EagerPages
+      self.Logger.debug("Pages after {0} of {1} will be rendered on demand".format(self.EagerPages, self.InputKey))
+    else:
+      Shards = self.PlanShards(NumPages)
+      FirstPage, LastPage = Shards[0] if Shards else (1, NumPages)
+    if Shards:
+      self.StartShards(Shards)
+
+    # Pages rendered by a previous run are kept, only the others are rendered
+    Rendered = {t['PageNumber'] for t in Previous if FirstPage <= t['PageNumber'] <= LastPage}
+    o_thumbs = [t for t in Previous if t['PageNumber'] in Rendered]
+    if Rendered:
+      self.Logger.debug("Keeping {0} pages of {1} rendered by a previous run".format(len(Rendered), self.InputKey))
+      PreviewSize = '{0}x{1}'.format(*THUMBNAIL_SIZES[0])
+      with self.OutputLock:
+        self.Output['Outputs'].extend(o_thumbs)
+        for t in o_thumbs:
+          if t['PageNumber'] == 1 and t['Key'].split('.')[-2] == PreviewSize:
+            self.Output['Preview'] = t
+
+    # Generate images from the pages of PDF, they are added to the outputs as they are uploaded.
+    # The text of the whole document is extracted meanwhile, from the same local PDF.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      o_text = executor.submit(self.ExtractPageText, OutputFilePath) if self.ExtractText else None
+      for first, last in MissingPageRanges(FirstPage=FirstPage, LastPage=LastPage, Rendered=Rendered):
+        o_thumbs.extend(self.GenerateImagesFromPDF(PDFPath=OutputFilePath, FirstPage=first, LastPage=last))
+      if o_text:
+        self.Output['Text'] = o_text.result()
+    if Rendered:
+      o_thumbs.sort(key=ThumbnailOrder)
+      with self.OutputLock:
+        self.Output['Outputs'] = [o for o in self.Output['Outputs'] if 'PageNumber' not in o] + o_thumbs
+    if Shards:
+      result = {'state': 'COMPLETED', 'Outputs': o_thumbs}
+      if o_text:
+        result['Text'] = self.Output['Text']
+      if self.Output.get('Preview'):
+        result['Preview'] = self.Output['Preview']
+      S3.PutJSON(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=self.ShardResultKey(FirstPage=FirstPage, LastPage=LastPage),
+        content=result,
+        )
 
     # Mark the new file for deletion
     self.MarkFilePathForCleanup(OutputFilePath)
@@ -133,16 +1263,215 @@ class S3BackedDocument(S3BackedFile):
 
 
 @Job
-def ConvertToPDF(*, InputKey, OutputKeyPrefix, Config, Logger, OutputKey='output.pdf'):
+def ConvertToPDF(*, InputKey, OutputKeyPrefix, Config, Logger, OutputKey='output.pdf', ExtraOutputs=(), DirectRender=True, SpritePages=None, EagerPages=None, OptimizePDF=None, ExtractText=None, CacheConversions=None):
   Logger.debug("ResizeImage job for {0} started".format(InputKey))
   # Prepare context in which we'll run
   ctxt = S3BackedDocument(
     InputKey=InputKey,
     OutputKeyPrefix=OutputKeyPrefix,
     OutputKey=OutputKey,
+    ExtraOutputs=ExtraOutputs,
+    DirectRender=DirectRender,
+    SpritePages=SpritePages,
+    EagerPages=EagerPages,
+    OptimizePDF=OptimizePDF,
+    ExtractText=ExtractText,
+    CacheConversions=CacheConversions,
     Config=Config,
     Logger=Logger,
     )
   # Start the processing
   with ctxt as doc:
     doc.Run()
+  # Split documents may have been finished by the other workers meanwhile
+  if ctxt.Deferred:
+    ctxt.MergeShards()
+
+
+def BatchConvert(*, Documents, Config, Logger):
+  """Convert office documents with the batch mode of the converter, over a single office connection
+
+  :param Documents: The documents to convert, already downloaded
+  :type Documents: list
+  :return: The result of the converter for each document, by document
+  :rtype: dict
+  """
+  if not Documents:
+    return {}
+  ManifestPath = S3BackedDocument.GetLocalFilePathFromS3Key(Key='batch-{0}.jsonl'.format(os.getpid()))
+  ResultsPath = S3BackedDocument.GetLocalFilePathFromS3Key(Key='batch-{0}-results.jsonl'.format(os.getpid()))
+  with open(ManifestPath, 'w') as fp:
+    for doc in Documents:
+      fp.write(json.dumps({'input': doc.LocalFilePath, 'outputs': doc.ConversionOutputFilePaths}) + '\n')
+  # The batch gets its own office, on a port nothing else listens on
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+  cmd = [Binaries.Python2, Binaries.DocumentConverter, '--batch', ManifestPath, '--results', ResultsPath, '--managed', '--port', str(port)]
+  if Config.Document_ConversionTimeout:
+    cmd.extend(('--timeout', str(Config.Document_ConversionTimeout)))
+  # NOTE: the exit status only tells whether some conversion failed, results tell which.
+  #       The office needs more address space than a job is allowed, only the deadline applies.
+  Governor.Call(cmd, Limited=False)
+  results = {}
+  if os.path.exists(ResultsPath):
+    with open(ResultsPath) as fp:
+      for line in fp:
+        result = json.loads(line)
+        results[result['input']] = result
+        Logger.debug("Converted {0} in {1} seconds".format(result['input'], result['seconds']))
+    os.remove(ResultsPath)
+  os.remove(ManifestPath)
+  return {
+    doc: results.get(doc.LocalFilePath, {'ok': False, 'error': "the converter did not report on {0}".format(doc.InputKey)})
+    for doc in Documents
+    }
+
+
+@Job
+def ConvertDocuments(*, Documents, Config, Logger, OutputKey='output.pdf', ExtraOutputs=(), DirectRender=True, SpritePages=None, EagerPages=None, OptimizePDF=None, ExtractText=None, CacheConversions=None):
+  """Convert many documents in a single session of the document converter, for bulk backfills
+
+  Every document gets its own output.json, as with ConvertToPDF, and a document that fails
+  does not stop the others. Documents are downloaded, converted and cleaned up a chunk at a
+  time so that the disk only ever holds a few of them. A document that is postponed is posted
+  again on its own, and once the deadline of the job passes, the documents left are posted
+  again as a job of their own.
+
+  :param Documents: (InputKey, OutputKeyPrefix) of every document
+  :type Documents: list
+  """
+  Logger.debug("ConvertDocuments job for {0} documents started".format(len(Documents)))
+  BatchSize = Config.Document_BatchSize or BATCH_SIZE
+  NumErrors = 0
+  NumPostponed = 0
+
+  def Repost(Documents, Delay=0):
+    job = ConvertDocumentsJob(
+      Documents=Documents,
+      OutputKey=OutputKey,
+      ExtraOutputs=ExtraOutputs,
+      DirectRender=DirectRender,
+      SpritePages=SpritePages,
+      EagerPages=EagerPages,
+      OptimizePDF=OptimizePDF,
+      ExtractText=ExtractText,
+      CacheConversions=CacheConversions,
+      )
+    SQS.PostMessage(Config.Session, Config.SQS_QueueUrl, job.ToJSON(), delay_seconds=Delay)
+
+  def Leave(ctxts, exc):
+    """Hand the documents that were not converted to another job, removing what they left on disk"""
+    Logger.error("TIMEOUT: {0}, posting the {1} documents left again".format(exc, len(Documents) - done))
+    for ctxt in ctxts:
+      for FilePath in ctxt.ConversionOutputFilePaths:
+        ctxt.MarkFilePathForCleanup(FilePath)
+      ctxt.Cleanup()
+    Repost(Documents[done:])
+
+  # Number of documents handled so far, the deadline of the job stops the loop
+  done = 0
+  TimedOut = False
+  for start in range(0, len(Documents), BatchSize):
+    if TimedOut:
+      break
+    ctxts = [
+      S3BackedDocument(
+        InputKey=InputKey,
+        OutputKeyPrefix=OutputKeyPrefix,
+        OutputKey=OutputKey,
+        ExtraOutputs=ExtraOutputs,
+        DirectRender=DirectRender,
+        SpritePages=SpritePages,
+        EagerPages=EagerPages,
+        OptimizePDF=OptimizePDF,
+        ExtractText=ExtractText,
+        CacheConversions=CacheConversions,
+        Config=Config,
+        Logger=Logger,
+        )
+      for InputKey, OutputKeyPrefix in Documents[start:start + BatchSize]
+      ]
+    try:
+      # Only office documents need the converter, the others are handled as usual and those
+      # converted before are taken from the conversion cache
+      batch = []
+      cached = set()
+      for ctxt in ctxts:
+        try:
+          if ctxt.Sniff(ctxt.LocalFilePath) is not None:
+            continue
+          if ctxt.LoadCachedConversion():
+            cached.add(ctxt)
+          else:
+            batch.append(ctxt)
+        except JobTimeoutException:
+          raise
+        except Exception:
+          # The error is reported in the output.json of the document below
+          Logger.exception("Could not download {0}".format(ctxt.InputKey))
+      results = BatchConvert(Documents=batch, Config=Config, Logger=Logger)
+    except JobTimeoutException as exc:
+      Leave(ctxts, exc)
+      break
+    # Upload and render the pages of every document, leaving the disk as it was
+    for i, ctxt in enumerate(ctxts):
+      done = start + i + 1
+      try:
+        with ctxt as doc:
+          result = results.get(doc)
+          if result and not result['ok']:
+            raise Exception("ERROR: {0}".format(result['error']))
+          doc.ConvertToPDF(Converted=bool(result), Cached=doc in cached)
+        if ctxt.Deferred:
+          ctxt.MergeShards()
+      except PostponeJobException as exc:
+        # The other documents are done, only this one runs again
+        NumPostponed += 1
+        Logger.info("Postponing {0} by {1} seconds: {2}".format(ctxt.InputKey, exc.Delay, exc))
+        Repost([(ctxt.InputKey, ctxt.OutputKeyPrefix)], Delay=exc.Delay)
+      except JobTimeoutException as exc:
+        # This document is reported as timed out in its output.json, the others go to another job
+        NumErrors += 1
+        Leave(ctxts[i + 1:], exc)
+        TimedOut = True
+        break
+      except Exception:
+        NumErrors += 1
+        Logger.exception("Could not convert {0}".format(ctxt.InputKey))
+  Logger.info("Converted {0} of {1} documents, {2} postponed, {3} left for another job".format(done - NumErrors - NumPostponed, len(Documents), NumPostponed, len(Documents) - done))
+
+
+@Job
+def RenderPages(*, InputKey, OutputKeyPrefix, FirstPage, LastPage, Config, Logger, OutputKey='output.pdf', DirectRender=True, SpritePages=None, Shard=False):
+  """Render a range of pages of a document already converted to PDF
+
+  Ranges of a split document are merged with the other ranges once all are done. Other
+  ranges are rendered on demand, skipping the pages already rendered, and added to the
+  output.json of the completed document.
+  """
+  Logger.debug("RenderPages job for pages {0} to {1} of {2} started".format(FirstPage, LastPage, InputKey))
+  # Prepare context in which we'll run
+  ctxt = S3BackedDocument(
+    InputKey=InputKey,
+    OutputKeyPrefix=OutputKeyPrefix,
+    OutputKey=OutputKey,
+    DirectRender=DirectRender,
+    SpritePages=SpritePages,
+    Config=Config,
+    Logger=Logger,
+    )
+  # The result of this range is merged with the others in output.json
+  if Shard:
+    ctxt.OutputJSONKey = ctxt.ShardResultKey(FirstPage=FirstPage, LastPage=LastPage)
+  else:
+    ctxt.OutputJSONKey = ctxt.PagesResultKey(FirstPage=FirstPage, LastPage=LastPage)
+  # Start the processing
+  try:
+    with ctxt as doc:
+      doc.RenderPages(FirstPage=FirstPage, LastPage=LastPage, OnDemand=not Shard)
+  finally:
+    if Shard:
+      ctxt.MergeShards()
+    else:
+      ctxt.MergePages()
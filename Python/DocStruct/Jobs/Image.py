@@ -1,9 +1,13 @@
 # vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+import os
 import os.path
+import math
+import shutil
 import collections
 import subprocess
 import mimetypes
 
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 from ..Base import GetSession, S3
 from . import Job, S3BackedFile
@@ -11,19 +15,43 @@ from . import Job, S3BackedFile
 
 Output = collections.namedtuple('Output', ('Width', 'Height', 'OutputKey'))
 
+# Animated outputs keep at most this many frames of the input
+MAX_ANIMATION_FRAMES = 50
+# Outputs with these extensions can hold an animation
+ANIMATED_EXTENSIONS = ('.gif', '.webp')
+# Outputs with this extension are built as a Deep Zoom tile pyramid
+DEEPZOOM_EXTENSION = '.dzi'
+DEEPZOOM_TILE_SIZE = 256
+DEEPZOOM_TILE_FORMAT = 'jpg'
+# Maximum number of tiles uploaded at the same time
+MAX_TILE_UPLOADS = 8
+DEEPZOOM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{0}" Overlap="0" Format="{1}">
+  <Size Width="{2}" Height="{3}"/>
+</Image>"""
+# Output extensions that hold each input format as is
+FORMAT_EXTENSIONS = {
+  'JPEG': ('.jpg', '.jpeg'),
+  'PNG': ('.png',),
+  'GIF': ('.gif',),
+  'WEBP': ('.webp',),
+  }
+
 
 class S3BackedImage(S3BackedFile):
 
-  def __init__(self, *, JobName, PreferredOutputs, **kwargs):
+  def __init__(self, *, JobName, PreferredOutputs, Animated=False, **kwargs):
     super().__init__(**kwargs)
     self.JobName = JobName
     self.PreferredOutputs = PreferredOutputs
+    self.Animated = Animated
     self._LocalFilePath = None
+    self._Preflight = None
 
   def Process(self, *, Output, Command):
     # Process the image by executing the given command
     self.Logger.debug("{0} job for {1} started".format(self.JobName, self.InputKey))
-    subprocess.check_output(Command, stderr=subprocess.STDOUT)
+    self.Governor.CheckOutput(Command)
     self.Logger.debug("{0} job for {1} completed".format(self.JobName, self.InputKey))
     # Upload new file to S3
     self.Logger.debug("Starting Upload of {0} to S3".format(Output.OutputKey))
@@ -44,18 +72,180 @@ class S3BackedImage(S3BackedFile):
     o_fprops['Key'] = o_key
     # Save the returned properties to create output.json
     self.Output['Outputs'].append(o_fprops)
+    self.PublishProgress()
     # Mark file for deletion
     self.MarkFilePathForCleanup(o_fpath)
     # Return key of the output
     return o_fprops
 
+  def UploadFile(self, *, FilePath, Key):
+    with open(FilePath, 'rb') as fp:
+      S3.PutObject(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=Key,
+        content=fp,
+        type_=mimetypes.guess_type(FilePath)[0] or "application/octet-stream",
+        # The bucket is looked up once by the caller, not for every file
+        create_bucket=False,
+        )
+    os.remove(FilePath)
+    return Key
+
+  def Tile(self, *, Output):
+    """Build a Deep Zoom tile pyramid of the input and upload it
+
+    Each level is downscaled from the cached pixels of the level above it, so
+    the input is decoded only once and every level is resized from an image twice
+    its size rather than from the full resolution. The .dzi descriptor is uploaded
+    last, once every tile is available.
+    """
+    self.Logger.debug("Building tile pyramid {0} for {1}".format(Output.OutputKey, self.InputKey))
+    TileSize = Output.Width or DEEPZOOM_TILE_SIZE
+    Name = os.path.splitext(Output.OutputKey)[0]
+    TilesDir = self.GetLocalFilePathFromS3Key(KeyPrefix=self.OutputKeyPrefix, Key=Name + '_files')
+    # Decode the input once into a memory mapped pixel cache that the top level reads from
+    BasePath = TilesDir + '.mpc'
+    self.MarkFilePathForCleanup(BasePath)
+    self.MarkFilePathForCleanup(TilesDir + '.cache')
+    self.Governor.CheckOutput((self.Binaries.Convert, *self.InputArguments(Output), '-strip', BasePath))
+    # The decoded size may differ from the declared one when the decoder scaled the input down
+    out = self.Governor.CheckOutput((self.Binaries.Identify, '-ping', '-format', '%w %h', BasePath))
+    Width, Height = (int(v) for v in out.decode('utf-8').split())
+    MaxLevel = math.ceil(math.log2(max(Width, Height, 1)))
+    # Every tile goes to the same bucket, make sure it exists once
+    try:
+      S3.GetOrCreateBuckets(self.Config.Session, self.Config.S3_OutputBucket)
+    except Exception:
+      # Same as S3.PutObject, we may not be allowed to list buckets but still to upload
+      pass
+    # Render levels top down, uploading tiles while the next level renders
+    tiles = []
+    NumUploads = self.Config.Image_MaxTileUploads or MAX_TILE_UPLOADS
+    SourcePath = BasePath
+    try:
+      with ThreadPoolExecutor(max_workers=NumUploads) as executor:
+        for level in range(MaxLevel, -1, -1):
+          scale = 2 ** (MaxLevel - level)
+          LevelDir = os.path.join(TilesDir, str(level))
+          os.makedirs(LevelDir, exist_ok=True)
+          cmd = [self.Binaries.Convert, SourcePath]
+          if level < MaxLevel:
+            # Halve the level above, and keep the pixels of this level cached for the level below it
+            LevelPath = '{0}-{1}.mpc'.format(TilesDir, level)
+            self.MarkFilePathForCleanup(LevelPath)
+            self.MarkFilePathForCleanup('{0}-{1}.cache'.format(TilesDir, level))
+            cmd.extend(('-resize', '{0}x{1}!'.format(math.ceil(Width / scale), math.ceil(Height / scale)), '-write', LevelPath))
+          else:
+            LevelPath = BasePath
+          self.Governor.CheckOutput(cmd + [
+            '-crop', '{0}x{0}'.format(TileSize),
+            '-set', 'filename:tile', '%[fx:page.x/{0}]_%[fx:page.y/{0}]'.format(TileSize),
+            '+repage', '+adjoin',
+            os.path.join(LevelDir, '%[filename:tile].{0}'.format(DEEPZOOM_TILE_FORMAT)),
+            ])
+          # The level above is not needed anymore
+          if SourcePath != BasePath:
+            os.remove(SourcePath)
+            os.remove(os.path.splitext(SourcePath)[0] + '.cache')
+          SourcePath = LevelPath
+          for fname in os.listdir(LevelDir):
+            key = os.path.join(self.OutputKeyPrefix, '{0}_files'.format(Name), str(level), fname)
+            tiles.append(executor.submit(self.UploadFile, FilePath=os.path.join(LevelDir, fname), Key=key))
+        # Raise errors from any of the uploads
+        NumTiles = len([t.result() for t in tiles])
+    finally:
+      shutil.rmtree(TilesDir, ignore_errors=True)
+    # Now that every tile is available, publish the descriptor
+    o_key = os.path.join(self.OutputKeyPrefix, Output.OutputKey)
+    S3.PutObject(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=o_key,
+      content=DEEPZOOM_XML.format(TileSize, DEEPZOOM_TILE_FORMAT, Width, Height),
+      type_="application/xml",
+      )
+    self.Logger.debug("Finished Upload of {0} tiles for {1}".format(NumTiles, Output.OutputKey))
+    # Tile pyramids are kept apart from the image versions in output.json
+    o_props = {
+      'Key': o_key,
+      'Type': 'DZI',
+      'Width': Width,
+      'Height': Height,
+      'TileSize': TileSize,
+      'Overlap': 0,
+      'Format': DEEPZOOM_TILE_FORMAT,
+      'TileKeyPrefix': os.path.join(self.OutputKeyPrefix, '{0}_files'.format(Name)),
+      'NumLevels': MaxLevel + 1,
+      'NumTiles': NumTiles,
+      }
+    self.Output.setdefault('Tiles', []).append(o_props)
+    return o_props
+
+  def Copy(self, *, Output):
+    """Copy the input to the output within S3 since it needs no transformation"""
+    self.Logger.debug("Copying {0} to {1} in S3".format(self.InputKey, Output.OutputKey))
+    o_key = os.path.join(self.OutputKeyPrefix, Output.OutputKey)
+    S3.CopyObject(
+      session=self.Config.Session,
+      source_bucket=self.Config.S3_InputBucket,
+      source_key=self.InputKey,
+      bucket=self.Config.S3_OutputBucket,
+      key=o_key,
+      type_=mimetypes.guess_type(Output.OutputKey)[0] or "application/octet-stream",
+      )
+    self.Logger.debug("Finished Copy of {0} in S3".format(Output.OutputKey))
+    # The output has the same properties as the input
+    o_fprops = {k: self._Preflight[k] for k in ('Type', 'Width', 'Height')}
+    o_fprops['Key'] = o_key
+    self.Output['Outputs'].append(o_fprops)
+    self.PublishProgress()
+    return o_fprops
+
+  def IsUnchanged(self, Output):
+    """Check if the input can be used as the given output as is"""
+    # Make sure the input has been inspected
+    self.LocalFilePath
+    i_props = self._Preflight
+    # Reduced decodes, conversions between formats and frame selection all transform the input
+    if self.DecodeOptions or i_props['NumFrames'] > 1:
+      return False
+    if os.path.splitext(Output.OutputKey)[1].lower() not in FORMAT_EXTENSIONS.get(i_props['Type'], ()):
+      return False
+    if self.JobName == 'NormalizeImage':
+      return (i_props['Width'], i_props['Height']) == (Output.Width, Output.Height)
+    if not Output.Width or not Output.Height:
+      return True
+    # -resize fits the image in the box, scaling it up too, so only an input that already fits
+    # it exactly, touching two of its sides, comes out of convert at its own size
+    Fits = i_props['Width'] <= Output.Width and i_props['Height'] <= Output.Height
+    return Fits and (i_props['Width'] == Output.Width or i_props['Height'] == Output.Height)
+
+  def InputArguments(self, Output):
+    """Arguments that make convert read the frames of the input needed for the given output"""
+    FilePath = self.LocalFilePath
+    NumFrames = self._Preflight['NumFrames']
+    # Only animated outputs need more than the first frame of an animation or a multi-page file
+    if self.Animated and NumFrames > 1 and os.path.splitext(Output.OutputKey)[1].lower() in ANIMATED_EXTENSIONS:
+      MaxFrames = min(NumFrames, self.Config.Image_MaxAnimationFrames or MAX_ANIMATION_FRAMES)
+      return self.DecodeOptions + ('{0}[0-{1}]'.format(FilePath, MaxFrames - 1), '-coalesce')
+    return self.DecodeOptions + ('{0}[0]'.format(FilePath),)
+
+  def OutputArguments(self, Output):
+    """Arguments that finish the output before it is written"""
+    if self.Animated and os.path.splitext(Output.OutputKey)[1].lower() in ANIMATED_EXTENSIONS:
+      return ('-layers', 'Optimize')
+    return ()
+
   @property
   def LocalFilePath(self):
     ret = super().LocalFilePath
     # Inspect the input file and save its properties first
-    i_fprops = self.InspectImage(ret)
-    i_fprops['Key'] = self.InputKey
-    self.Output['Input'] = i_fprops
+    if self._Preflight is None:
+      self._Preflight = self.Preflight(ret)
+      i_fprops = dict(self._Preflight)
+      i_fprops['Key'] = self.InputKey
+      self.Output['Input'] = i_fprops
     # Return original
     return ret
 
@@ -67,17 +257,25 @@ class S3BackedImage(S3BackedFile):
     # Loop over required outputs to create them
     for o_ in self.PreferredOutputs:
       o = Output(*o_)
+      if o.OutputKey.endswith(DEEPZOOM_EXTENSION):
+        self.Tile(Output=o)
+        continue
+      if self.IsUnchanged(o):
+        self.Copy(Output=o)
+        continue
       if not o.Width or not o.Height:
         cmd = (
           self.Binaries.Convert,
-          FilePath,
+          *self.InputArguments(o),
+          *self.OutputArguments(o),
           self.GetLocalFilePathFromS3Key(KeyPrefix=self.OutputKeyPrefix, Key=o.OutputKey),
           )
       else:
         cmd = (
           self.Binaries.Convert,
-          FilePath,
+          *self.InputArguments(o),
           '-resize', '{0}x{1}'.format(str(o.Width), str(o.Height)),
+          *self.OutputArguments(o),
           self.GetLocalFilePathFromS3Key(KeyPrefix=self.OutputKeyPrefix, Key=o.OutputKey),
           )
       # Now run the command
@@ -91,12 +289,16 @@ class S3BackedImage(S3BackedFile):
     # Loop over required outputs to create them
     for o_ in self.PreferredOutputs:
       o = Output(*o_)
+      if self.IsUnchanged(o):
+        self.Copy(Output=o)
+        continue
       cmd = (
         self.Binaries.Convert,
-        FilePath,
+        *self.InputArguments(o),
         '-resize', '{0}x{1}^'.format(str(o.Width), str(o.Height)),
         '-gravity', 'Center',
         '-extent', '{0}x{1}'.format(str(o.Width), str(o.Height)),
+        *self.OutputArguments(o),
         self.GetLocalFilePathFromS3Key(KeyPrefix=self.OutputKeyPrefix, Key=o.OutputKey),
         )
       # Now run the command
@@ -111,7 +313,7 @@ class S3BackedImage(S3BackedFile):
 
 
 @Job
-def ResizeImage(*, InputKey, OutputKeyPrefix, PreferredOutputs, Config, Logger):
+def ResizeImage(*, InputKey, OutputKeyPrefix, PreferredOutputs, Config, Logger, Animated=False):
   # Prepare context in which we'll run
   ctxt = S3BackedImage(
     InputKey=InputKey,
@@ -120,6 +322,7 @@ def ResizeImage(*, InputKey, OutputKeyPrefix, PreferredOutputs, Config, Logger):
     Logger=Logger,
     JobName='ResizeImage',
     PreferredOutputs=PreferredOutputs,
+    Animated=Animated,
     )
   # Start the processing
   with ctxt as im:
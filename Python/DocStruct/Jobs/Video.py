@@ -1,12 +1,378 @@
 # vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+import os
+import json
+import math
+import shutil
+import subprocess
+import mimetypes
+
 from os.path import basename
-from DocStruct.Base import ElasticTranscoder
-from . import Job
+from concurrent.futures import ThreadPoolExecutor
+from DocStruct.Base import ElasticTranscoder, S3
+from . import Job, S3BackedFile, NoMoreRetriesException
 
 
-@Job
-def TranscodeVideo(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger):
-  Logger.debug("TranscodeVideo started for {0}".format(InputKey))
+# Backend transcoding the videos, unless configured otherwise in Video.Backend
+VIDEO_BACKEND = 'ElasticTranscoder'
+# Key of the transcoded video and preset of every output format
+OUTPUT_PRESETS = {
+  'webm': ('video.webm', ElasticTranscoder.WEBM_PRESET_DATA),
+  'mp4': ('video.mp4', ElasticTranscoder.WEB_PRESET_DATA),
+  }
+# The audio track is encoded on its own, in a file with this extension, then muxed with the video
+AUDIO_EXTENSIONS = {
+  'webm': '.webm',
+  'mp4': '.m4a',
+  }
+# ffmpeg encoder of every codec named in the presets
+FFMPEG_CODECS = {
+  'vp8': 'libvpx',
+  'H.264': 'libx264',
+  'vorbis': 'libvorbis',
+  'AAC': 'aac',
+  }
+# Number of seconds of video encoded by a single ffmpeg process, the segments are encoded in parallel
+SEGMENT_DURATION = 60
+# Renditions of the adaptive stream as (height, video kbps, audio kbps), those taller than the input are left out.
+# Inputs shorter than the first rendition get a single one at their own height, with its bitrates.
+HLS_LADDER = (
+  (240, 400, 64),
+  (360, 800, 96),
+  (480, 1200, 128),
+  (720, 2400, 128),
+  (1080, 4800, 160),
+  )
+# Number of seconds of every segment of the adaptive stream
+HLS_SEGMENT_DURATION = 6
+# Where the adaptive stream is written, relative to the output key prefix
+HLS_KEY_PREFIX = 'hls'
+HLS_MASTER_PLAYLIST = 'master.m3u8'
+# Content types of the files of the adaptive stream
+HLS_TYPES = {
+  '.m3u8': 'application/vnd.apple.mpegurl',
+  '.ts': 'video/mp2t',
+  }
+# Maximum number of segments uploaded at the same time
+MAX_SEGMENT_UPLOADS = 8
+
+
+def DisplaySize(Stream):
+  """Width and height of a video stream as players show it, ffmpeg rotates the frames the same way
+
+  The rotation is in the side data of recent ffprobe versions and in the tags of older ones.
+  """
+  rotation = Stream.get('tags', {}).get('rotate') or 0
+  for data in Stream.get('side_data_list', []):
+    if 'rotation' in data:
+      rotation = data['rotation']
+  if int(float(rotation)) % 180:
+    return Stream['height'], Stream['width']
+  return Stream['width'], Stream['height']
+
+
+class S3BackedVideo(S3BackedFile):
+  """Transcodes a video on this host with ffmpeg
+
+  output.json is written in the shape of the notifications of ElasticTranscoder, so that
+  the versions are added the same way whichever backend transcoded the video.
+  """
+
+  def __init__(self, *, OutputFormats, **kw):
+    super().__init__(**kw)
+    self.OutputFormats = OutputFormats
+    self.Output = {
+      'state': 'PROGRESSING',
+      'input': {'key': self.InputKey},
+      'outputKeyPrefix': '{0}/'.format(self.OutputKeyPrefix),
+      'outputs': [],
+      }
+
+  def FFmpeg(self, Arguments, NumProcesses=1):
+    """Run ffmpeg, NumProcesses being the number of ffmpeg processes the job runs at once
+
+    The cpu time of an encode grows with the length of the video, so ffmpeg is spared the
+    rlimits and only the deadline of the job stops it.
+    """
+    try:
+      self.Governor.CheckOutput((self.Binaries.FFmpeg, '-y', '-nostdin', '-v', 'error') + tuple(Arguments), Limited=False, NumProcesses=NumProcesses)
+    except subprocess.CalledProcessError as exc:
+      raise Exception("ERROR: {0}".format(exc.output.decode('utf-8', 'replace').strip()))
+
+  def Probe(self, FilePath):
+    """Get the duration and the streams of a video
+
+    :return: (duration in seconds, video stream, audio stream), the duration is None when
+             unknown, EX: streams without an index, and a missing stream is None
+    :rtype: tuple
+    """
+    # Warnings go to stderr, only stdout holds the JSON
+    try:
+      out = self.Governor.CheckOutput((
+        self.Binaries.FFprobe,
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        FilePath,
+        ), stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as exc:
+      raise NoMoreRetriesException("ERROR: could not read {0}: {1}".format(self.InputKey, exc.stderr.decode('utf-8', 'replace').strip()))
+    info = json.loads(out.decode('utf-8'))
+    streams = {}
+    for stream in info.get('streams', []):
+      streams.setdefault(stream.get('codec_type'), stream)
+    video = streams.get('video')
+    duration = info.get('format', {}).get('duration') or (video or {}).get('duration')
+    return (float(duration) if duration else None), video, streams.get('audio')
+
+  def VideoOptions(self, Preset):
+    video = Preset['video']
+    options = [
+      '-c:v', FFMPEG_CODECS[video['Codec']],
+      '-b:v', '{0}k'.format(video['BitRate']),
+      '-g', video['KeyframesMaxDist'],
+      '-pix_fmt', 'yuv420p',
+      # Shrink to fit keeping the aspect ratio, the encoders need even dimensions
+      '-vf', "scale='min({0},iw)':'min({1},ih)':force_original_aspect_ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2".format(video['MaxWidth'], video['MaxHeight']),
+      ]
+    if video['FrameRate'] != 'auto':
+      options.extend(('-r', video['FrameRate']))
+    if video['Codec'] == 'H.264':
+      options.extend(('-profile:v', video['CodecOptions']['Profile'], '-level', video['CodecOptions']['Level']))
+    return options
+
+  def AudioOptions(self, Preset):
+    audio = Preset['audio']
+    return [
+      '-c:a', FFMPEG_CODECS[audio['Codec']],
+      '-b:a', '{0}k'.format(audio['BitRate']),
+      '-ar', audio['SampleRate'],
+      '-ac', audio['Channels'],
+      ]
+
+  def Transcode(self, *, Format, Duration, HasAudio):
+    """Transcode the video to one format and upload it
+
+    The video is cut in segments encoded in parallel then joined without being encoded
+    again, the audio track is encoded in one piece alongside so that it has no gaps. A
+    video of unknown duration cannot be cut and is encoded in one piece.
+
+    :return: The output, as described by ElasticTranscoder
+    :rtype: dict
+    """
+    Key, Preset = OUTPUT_PRESETS[Format]
+    OutputFilePath = self.GetLocalFilePathFromS3Key(Key=Key, KeyPrefix=self.OutputKeyPrefix)
+    self.MarkFilePathForCleanup(OutputFilePath)
+    BasePath, Extension = os.path.splitext(OutputFilePath)
+    SegmentDuration = self.Config.Video_SegmentDuration or SEGMENT_DURATION
+    segments = []
+    for i in range(math.ceil(Duration / SegmentDuration) if Duration else 1):
+      SegmentPath = '{0}-{1}{2}'.format(BasePath, i, Extension)
+      self.MarkFilePathForCleanup(SegmentPath)
+      segments.append((i * SegmentDuration, SegmentPath))
+    AudioPath = '{0}-audio{1}'.format(BasePath, AUDIO_EXTENSIONS[Format])
+    self.MarkFilePathForCleanup(AudioPath)
+    # The threads and the memory of the job are shared by the processes running at once
+    NumProcesses = min(self.Governor.NumThreads, len(segments) + (1 if HasAudio else 0))
+
+    def EncodeSegment(Start, SegmentPath):
+      cmd = ['-ss', str(Start), '-t', str(SegmentDuration)] if Duration else []
+      self.FFmpeg(cmd + [
+        '-i', self.LocalFilePath,
+        '-an',
+        *self.VideoOptions(Preset),
+        '-threads', str(self.Governor.ThreadsPerProcess(NumProcesses)),
+        SegmentPath,
+        ], NumProcesses=NumProcesses)
+
+    def EncodeAudio():
+      self.FFmpeg(('-i', self.LocalFilePath, '-vn', *self.AudioOptions(Preset), AudioPath), NumProcesses=NumProcesses)
+
+    self.Logger.debug("Transcoding {0} to {1} in {2} segments".format(self.InputKey, Format, len(segments)))
+    with ThreadPoolExecutor(max_workers=NumProcesses) as executor:
+      futures = [executor.submit(EncodeSegment, start, path) for start, path in segments]
+      if HasAudio:
+        futures.append(executor.submit(EncodeAudio))
+      for future in futures:
+        future.result()
+
+    # Join the segments, and the audio track
+    ListPath = '{0}-segments.txt'.format(BasePath)
+    self.MarkFilePathForCleanup(ListPath)
+    with open(ListPath, 'w') as fp:
+      for start, path in segments:
+        fp.write("file '{0}'\n".format(path.replace("'", "'\\''")))
+    cmd = ['-f', 'concat', '-safe', '0', '-i', ListPath]
+    if HasAudio:
+      cmd.extend(('-i', AudioPath, '-map', '0:v', '-map', '1:a'))
+    cmd.extend(('-c', 'copy'))
+    if Format == 'mp4':
+      # Players can start before the whole file is downloaded
+      cmd.extend(('-movflags', '+faststart'))
+    self.FFmpeg(cmd + [OutputFilePath])
+    for start, path in segments:
+      os.remove(path)
+
+    # Upload the video to S3
+    o_key = os.path.join(self.OutputKeyPrefix, Key)
+    with open(OutputFilePath, 'rb') as fp:
+      S3.PutObject(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=o_key,
+        content=fp,
+        type_=mimetypes.guess_type(OutputFilePath)[0] or "application/octet-stream",
+        )
+    self.Logger.debug("Finished Upload of {0} to S3".format(o_key))
+    duration, video, audio = self.Probe(OutputFilePath)
+    Width, Height = DisplaySize(video)
+    return {
+      'id': str(len(self.Output['outputs']) + 1),
+      'presetId': Preset['name'],
+      'key': Key,
+      'status': 'Complete',
+      'duration': int(round(duration or 0)),
+      'width': Width,
+      'height': Height,
+      }
+
+  def UploadFile(self, *, FilePath, Key):
+    with open(FilePath, 'rb') as fp:
+      S3.PutObject(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=Key,
+        content=fp,
+        type_=HLS_TYPES.get(os.path.splitext(FilePath)[1]) or "application/octet-stream",
+        )
+    return Key
+
+  def TranscodeHLS(self, *, Duration, Video, HasAudio):
+    """Transcode the video to an adaptive stream and upload it
+
+    Every rendition of the bitrate ladder is encoded in parallel and cut in segments
+    starting on a keyframe, so that players can switch between renditions at any
+    segment. The master playlist listing the renditions is uploaded last.
+
+    :return: The output, as described by ElasticTranscoder, along with the renditions
+    :rtype: dict
+    """
+    SegmentDuration = self.Config.Video_HLSSegmentDuration or HLS_SEGMENT_DURATION
+    # Heights of the ladder are those of the rotated video, as scaled by ffmpeg
+    VideoWidth, VideoHeight = DisplaySize(Video)
+    # Videos are never scaled up, the encoder needs an even height
+    ladder = [rung for rung in HLS_LADDER if rung[0] <= VideoHeight] or [(VideoHeight // 2 * 2,) + HLS_LADDER[0][1:]]
+    StreamDir = self.GetLocalFilePathFromS3Key(Key=HLS_KEY_PREFIX, KeyPrefix=self.OutputKeyPrefix)
+    # Renditions are encoded at the same time, at most one per thread of the job, each with its share
+    NumProcesses = min(self.Governor.NumThreads, len(ladder))
+    renditions = []
+
+    def EncodeRendition(Height, VideoBitRate, AudioBitRate):
+      RenditionDir = os.path.join(StreamDir, '{0}p'.format(Height))
+      os.makedirs(RenditionDir, exist_ok=True)
+      cmd = [
+        '-i', self.LocalFilePath,
+        '-map', '0:v:0',
+        '-c:v', 'libx264',
+        '-profile:v', 'main',
+        '-b:v', '{0}k'.format(VideoBitRate),
+        '-maxrate', '{0}k'.format(VideoBitRate * 107 // 100),
+        '-bufsize', '{0}k'.format(VideoBitRate * 3 // 2),
+        '-vf', 'scale=-2:{0}'.format(Height),
+        '-pix_fmt', 'yuv420p',
+        # Segments of every rendition start at the same time, on a keyframe
+        '-force_key_frames', 'expr:gte(t,n_forced*{0})'.format(SegmentDuration),
+        '-sc_threshold', '0',
+        ]
+      if HasAudio:
+        cmd.extend(('-map', '0:a:0', '-c:a', 'aac', '-b:a', '{0}k'.format(AudioBitRate), '-ar', '44100', '-ac', '2'))
+      cmd.extend((
+        '-threads', str(self.Governor.ThreadsPerProcess(NumProcesses)),
+        '-f', 'hls',
+        '-hls_time', str(SegmentDuration),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(RenditionDir, 'segment%05d.ts'),
+        os.path.join(RenditionDir, 'playlist.m3u8'),
+        ))
+      self.FFmpeg(cmd, NumProcesses=NumProcesses)
+      return RenditionDir
+
+    self.Logger.debug("Transcoding {0} to HLS in {1} renditions".format(self.InputKey, len(ladder)))
+    try:
+      with ThreadPoolExecutor(max_workers=NumProcesses) as executor:
+        dirs = [executor.submit(EncodeRendition, *rung) for rung in ladder]
+        dirs = [d.result() for d in dirs]
+      # Whatever the input says, the renditions know how long they are
+      if Duration is None:
+        Duration = self.Probe(os.path.join(dirs[0], 'playlist.m3u8'))[0]
+      # Upload the segments and the playlist of every rendition
+      NumUploads = self.Config.Video_MaxSegmentUploads or MAX_SEGMENT_UPLOADS
+      with ThreadPoolExecutor(max_workers=NumUploads) as executor:
+        uploads = []
+        for RenditionDir in dirs:
+          for fname in sorted(os.listdir(RenditionDir)):
+            key = os.path.join(self.OutputKeyPrefix, HLS_KEY_PREFIX, os.path.basename(RenditionDir), fname)
+            uploads.append(executor.submit(self.UploadFile, FilePath=os.path.join(RenditionDir, fname), Key=key))
+        # Raise errors from any of the uploads
+        NumSegments = len([u.result() for u in uploads])
+    finally:
+      shutil.rmtree(StreamDir, ignore_errors=True)
+    self.Logger.debug("Finished Upload of {0} files of the HLS stream of {1}".format(NumSegments, self.InputKey))
+
+    # Now that every rendition is available, publish the master playlist
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for Height, VideoBitRate, AudioBitRate in ladder:
+      Width = round(VideoWidth * Height / VideoHeight / 2) * 2
+      BandWidth = (VideoBitRate * 107 // 100 + (AudioBitRate if HasAudio else 0)) * 1000
+      lines.append('#EXT-X-STREAM-INF:BANDWIDTH={0},RESOLUTION={1}x{2}'.format(BandWidth, Width, Height))
+      lines.append('{0}p/playlist.m3u8'.format(Height))
+      renditions.append({
+        'key': '{0}/{1}p/playlist.m3u8'.format(HLS_KEY_PREFIX, Height),
+        'width': Width,
+        'height': Height,
+        'bandwidth': BandWidth,
+        })
+    Key = '{0}/{1}'.format(HLS_KEY_PREFIX, HLS_MASTER_PLAYLIST)
+    S3.PutObject(
+      session=self.Config.Session,
+      bucket=self.Config.S3_OutputBucket,
+      key=os.path.join(self.OutputKeyPrefix, Key),
+      content='\n'.join(lines) + '\n',
+      type_=HLS_TYPES['.m3u8'],
+      )
+    return {
+      'id': str(len(self.Output['outputs']) + 1),
+      'presetId': 'HLS',
+      'key': Key,
+      'status': 'Complete',
+      'duration': int(round(Duration or 0)),
+      'width': renditions[-1]['width'],
+      'height': renditions[-1]['height'],
+      'renditions': renditions,
+      }
+
+  def Run(self):
+    Duration, video, audio = self.Probe(self.LocalFilePath)
+    if not video:
+      raise NoMoreRetriesException("ERROR: {0} does not contain any video".format(self.InputKey))
+    for Format in self.OutputFormats:
+      if Format == 'hls':
+        # The adaptive stream is optional, the other formats are kept when it fails
+        try:
+          output = self.TranscodeHLS(Duration=Duration, Video=video, HasAudio=audio is not None)
+        except Exception as exc:
+          self.Logger.exception("Could not stream {0} over HLS".format(self.InputKey))
+          with self.OutputLock:
+            self.Output.setdefault('skippedOutputs', []).append({'format': Format, 'error': str(exc)})
+          continue
+      else:
+        output = self.Transcode(Format=Format, Duration=Duration, HasAudio=audio is not None)
+      with self.OutputLock:
+        self.Output['outputs'].append(output)
+      self.PublishProgress()
+
+
+def TranscodeWithElasticTranscoder(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger):
   # Convert formats to output types
   Outputs = []
   for o in OutputFormats:
@@ -14,6 +380,8 @@ def TranscodeVideo(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger):
       Outputs.append({'Key': 'video.webm', 'PresetId': basename(Config.ElasticTranscoder_WebmPresetArn)})
     elif o == 'mp4':
       Outputs.append({'Key': 'video.mp4', 'PresetId': basename(Config.ElasticTranscoder_WebPresetArn)})
+    else:
+      Logger.info("ElasticTranscoder has no preset for {0}, {1} will not be transcoded to it".format(o, InputKey))
   # Set Pipeline ID
   PipelineId = basename(Config.ElasticTranscoder_PipelineArn)
   # Trigger the transcoding
@@ -25,5 +393,39 @@ def TranscodeVideo(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger):
     outputs=Outputs
     )
   Logger.debug("ElasticTranscoder job created: {0}".format(ret["Job"]["Arn"]))
-  # Now we are ready to return
+  # Now we are ready to return, output.json is written once the transcoder notifies us
   return ret
+
+
+def TranscodeWithFFmpeg(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger):
+  ctxt = S3BackedVideo(
+    InputKey=InputKey,
+    OutputKeyPrefix=OutputKeyPrefix,
+    OutputFormats=OutputFormats,
+    Config=Config,
+    Logger=Logger,
+    )
+  with ctxt as video:
+    video.Run()
+
+
+# Transcoding backends by name
+BACKENDS = {
+  'ElasticTranscoder': TranscodeWithElasticTranscoder,
+  'ffmpeg': TranscodeWithFFmpeg,
+  }
+
+
+@Job
+def TranscodeVideo(*, InputKey, OutputKeyPrefix, OutputFormats, Config, Logger, Backend=None):
+  Logger.debug("TranscodeVideo started for {0}".format(InputKey))
+  Backend = Backend or Config.Video_Backend or VIDEO_BACKEND
+  if Backend not in BACKENDS:
+    raise NoMoreRetriesException("ERROR: {0} is not a video backend".format(Backend))
+  return BACKENDS[Backend](
+    InputKey=InputKey,
+    OutputKeyPrefix=OutputKeyPrefix,
+    OutputFormats=OutputFormats,
+    Config=Config,
+    Logger=Logger,
+    )
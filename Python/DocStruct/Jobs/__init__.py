@@ -4,8 +4,12 @@ import os
 import os.path
 import re
 import json
+import math
 import time
+import signal
 import logging
+import threading
+import resource
 import subprocess
 
 from abc import ABCMeta, abstractmethod
@@ -16,6 +20,22 @@ from DocStruct.Base import GetSession, S3, SQS
 
 DATADIR_PATH = '/tmp'
 NUM_MAX_RETRIES = 3
+# Minimum number of seconds between two intermediate writes of output.json
+PROGRESS_INTERVAL = 5
+# Number of seconds a job may run, unless configured otherwise in Jobs.Deadlines by job name
+JOB_DEADLINE = 1800
+JOB_DEADLINES = {
+  'ConvertDocuments': 6 * 3600,
+  'TranscodeVideo': 3 * 3600,
+  }
+# Line printed by identify for every image, the path comes last since it may contain spaces
+IDENTIFY_FORMAT = '%m %w %h %i\n'
+# Images with more pixels than this are decoded at a reduced resolution when the format allows it
+# NOTE: each of these limits can be overridden in the config under the "Image" section
+MAX_DECODE_PIXELS = 50 * 1000 * 1000
+# Images with more pixels or frames than these are rejected before any decoding happens
+MAX_INPUT_PIXELS = 500 * 1000 * 1000
+MAX_INPUT_FRAMES = 1000
 JOBS_MAP = {}
 
 
@@ -26,6 +46,8 @@ class BinariesClass():
   _Identify = ""
   _Convert = ""
   _DocumentConverter = ""
+  _FFmpeg = ""
+  _FFprobe = ""
   
   @property
   def Python2(self):
@@ -83,6 +105,28 @@ class BinariesClass():
         sys.exit(1)
     return self._Convert
   
+  @property
+  def FFmpeg(self):
+    if not self._FFmpeg:
+      try:
+        out = subprocess.check_output('which ffmpeg', stderr=subprocess.STDOUT, shell=True)
+        type(self)._FFmpeg = out.decode('utf-8').strip()
+      except subprocess.CalledProcessError:
+        # Only the video jobs need it, they fail without bringing the jobs processor down
+        raise NoMoreRetriesException("ERROR: ffmpeg is not installed, please install ffmpeg before transcoding videos with it")
+    return self._FFmpeg
+
+  @property
+  def FFprobe(self):
+    if not self._FFprobe:
+      try:
+        out = subprocess.check_output('which ffprobe', stderr=subprocess.STDOUT, shell=True)
+        type(self)._FFprobe = out.decode('utf-8').strip()
+      except subprocess.CalledProcessError:
+        # Only the video jobs need it, they fail without bringing the jobs processor down
+        raise NoMoreRetriesException("ERROR: ffprobe is not installed, please install ffmpeg before transcoding videos with it")
+    return self._FFprobe
+
   @property
   def DocumentConverter(self):
     if not self._DocumentConverter:
@@ -101,28 +145,258 @@ class BinariesClass():
           sys.exit(1)
       
       type(self)._DocumentConverter = converter_path
-
-      # Try to see if we can use the document converter to convert documents
-      try:
-        subprocess.check_output((self.Python2, self._DocumentConverter, '/tmp/invalid.doc', '/tmp/invalid.pdf'), stderr=subprocess.STDOUT)
-      except subprocess.CalledProcessError as exc:
-        if re.search(r'failed to connect', exc.output.decode('utf-8')):
-          print()
-          print("Seems like we couldn't establish a connection to the headless openoffice server.")
-          print("Please start the headless openoffice server before starting the jobs processor.")
-          print()
-          sys.exit(1)
     return self._DocumentConverter
   
 
 Binaries = BinariesClass()
 
 
+class ResourceGovernorClass():
+  """Sizes the resources available to every external process launched by a job
+
+  Limits are derived from the cores and memory of the host, shared equally
+  between the jobs processors that run concurrently on it. ImageMagick picks
+  its limits up from the environment, ghostscript through its command line,
+  and the kernel enforces the address space and cpu time rlimits. A job that
+  runs several processes at once splits its share between them.
+
+  Every process also gets what is left of the deadline of the running job. Each
+  one leads its own process group so that everything it started goes away with it.
+  Once the signal handlers are installed, a watchdog timer also stops a job that
+  overruns its deadline outside of any process, and the process groups still running
+  are killed along with the jobs processor when it is told to stop.
+  """
+
+  NumConcurrentJobs = 1
+  MaxCPUSeconds = 1800
+  MinMemoryPerJob = 256 * 1024 * 1024
+  # Processes running alongside others of the same job never get less than this
+  MinMemoryPerProcess = 128 * 1024 * 1024
+  # Seconds a process group has to exit after SIGTERM before it gets SIGKILL
+  KillGracePeriod = 5
+  Deadline = None
+
+  def __init__(self):
+    # Processes launched by Popen that have not been waited for yet, from any thread
+    self.Processes = set()
+    self.ProcessesLock = threading.RLock()
+    self.Watchdog = False
+
+  @property
+  def NumCores(self):
+    return os.cpu_count() or 1
+
+  @property
+  def TotalMemory(self):
+    try:
+      return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+      return 4 * self.MinMemoryPerJob
+
+  @property
+  def NumThreads(self):
+    return max(1, self.NumCores // max(1, self.NumConcurrentJobs))
+
+  @property
+  def MemoryPerJob(self):
+    return max(self.MinMemoryPerJob, self.TotalMemory // max(1, self.NumConcurrentJobs))
+
+  def ThreadsPerProcess(self, NumProcesses=1):
+    """Share of the threads of the job for each of NumProcesses processes running at once"""
+    return max(1, self.NumThreads // max(1, NumProcesses))
+
+  def MemoryPerProcess(self, NumProcesses=1):
+    """Share of the memory of the job for each of NumProcesses processes running at once"""
+    if NumProcesses <= 1:
+      return self.MemoryPerJob
+    return max(self.MinMemoryPerProcess, self.MemoryPerJob // NumProcesses)
+
+  def Environment(self, NumProcesses=1):
+    NumThreads = self.ThreadsPerProcess(NumProcesses)
+    Memory = self.MemoryPerProcess(NumProcesses)
+    env = dict(os.environ)
+    env.update({
+      'OMP_NUM_THREADS': str(NumThreads),
+      'MAGICK_THREAD_LIMIT': str(NumThreads),
+      # Keep half of our share in RAM and let the rest spill to a memory mapped disk cache
+      'MAGICK_MEMORY_LIMIT': '{0}MiB'.format(Memory // 2 // 1024 ** 2),
+      'MAGICK_MAP_LIMIT': '{0}MiB'.format(Memory // 1024 ** 2),
+      'MAGICK_TIME_LIMIT': str(self.MaxCPUSeconds),
+      })
+    return env
+
+  def GhostscriptArguments(self, NumProcesses=1):
+    bufferspace = min(self.MemoryPerProcess(NumProcesses) // 8, 256 * 1024 ** 2)
+    return (
+      '-dNumRenderingThreads={0}'.format(self.ThreadsPerProcess(NumProcesses)),
+      '-dBufferSpace={0}'.format(bufferspace),
+      '-dMaxBitmap={0}'.format(bufferspace),
+      )
+
+  def StartDeadline(self, Seconds):
+    """Give the running job Seconds to finish, None lifts the deadline"""
+    self.Deadline = None if Seconds is None else time.time() + Seconds
+    if self.Watchdog:
+      signal.setitimer(signal.ITIMER_REAL, Seconds or 0)
+
+  def InstallSignalHandlers(self):
+    """Enforce deadlines with a watchdog timer and kill the running processes when stopped
+
+    NOTE: signal handlers run in the main thread only, jobs must run in it too.
+    """
+    signal.signal(signal.SIGALRM, self.Expire)
+    for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGINT):
+      signal.signal(signum, self.Terminate)
+    self.Watchdog = True
+
+  def Expire(self, signum, frame):
+    """Stop a job that overran its deadline, wherever it is"""
+    self.KillAll()
+    raise JobTimeoutException("ERROR: the job did not finish before its deadline")
+
+  def Terminate(self, signum, frame):
+    """Stop the jobs processor without leaving anything running behind it"""
+    self.StartDeadline(None)
+    self.KillAll()
+    raise SystemExit("ERROR: the jobs processor was stopped by signal {0}".format(signum))
+
+  def KillAll(self):
+    """Kill the process group of every process launched by Popen and still running
+
+    As with Kill, the groups get SIGTERM first and SIGKILL after the grace period.
+    """
+    with self.ProcessesLock:
+      procs = list(self.Processes)
+    for proc in procs:
+      self.SignalGroup(proc, signal.SIGTERM)
+    GraceDeadline = time.time() + self.KillGracePeriod
+    while time.time() < GraceDeadline and any(proc.poll() is None for proc in procs):
+      time.sleep(0.1)
+    for proc in procs:
+      self.SignalGroup(proc, signal.SIGKILL)
+
+  def SignalGroup(self, proc, signum):
+    try:
+      os.killpg(proc.pid, signum)
+    except ProcessLookupError:
+      # Everything in the group has exited already
+      pass
+
+  @property
+  def RemainingTime(self):
+    if self.Deadline is None:
+      return None
+    return max(0, self.Deadline - time.time())
+
+  def CheckDeadline(self, Command=None):
+    if self.Deadline is not None and time.time() >= self.Deadline:
+      what = os.path.basename(Command[0]) if Command else "the job"
+      raise JobTimeoutException("ERROR: {0} did not finish before the deadline of the job".format(what))
+
+  def Kill(self, proc):
+    """Kill a process launched by Popen along with everything it started
+
+    The group gets SIGTERM first so that a process which started others in sessions of
+    their own, EX: the batch converter and its office, can stop them before going away.
+    """
+    self.SignalGroup(proc, signal.SIGTERM)
+    try:
+      proc.wait(timeout=self.KillGracePeriod)
+    except subprocess.TimeoutExpired:
+      pass
+    self.SignalGroup(proc, signal.SIGKILL)
+    proc.wait()
+
+  def PrepareCommand(self, Command, NumProcesses=1):
+    Command = tuple(Command)
+    # NOTE: compare with the resolved path only, a lookup would abort when ghostscript is missing
+    if Binaries._Ghostscript and Command[0] == Binaries._Ghostscript:
+      Command = Command[:1] + self.GhostscriptArguments(NumProcesses) + Command[1:]
+    return Command
+
+  def Popen(self, Command, *, Limited=True, NumProcesses=1, **kwargs):
+    """Launch a governed process
+
+    :param Limited: False spares the process the rlimits, it still gets the deadline
+    :param NumProcesses: Number of processes the job runs at once, this one included
+    """
+    self.CheckDeadline(Command)
+    preexec_fn = None
+    if Limited:
+      aslimit = 2 * self.MemoryPerProcess(NumProcesses)
+      cpulimit = self.MaxCPUSeconds
+      # NOTE: the limits must hold before the binary is executed. This only calls setrlimit,
+      #       which takes no lock, so it is safe even though jobs launch processes from several threads.
+      def preexec_fn():
+        resource.setrlimit(resource.RLIMIT_AS, (aslimit, aslimit))
+        resource.setrlimit(resource.RLIMIT_CPU, (cpulimit, cpulimit))
+    proc = subprocess.Popen(
+      self.PrepareCommand(Command, NumProcesses),
+      env=self.Environment(NumProcesses),
+      start_new_session=True,
+      preexec_fn=preexec_fn,
+      **kwargs
+      )
+    with self.ProcessesLock:
+      self.Processes.add(proc)
+    return proc
+
+  def Wait(self, proc, Command):
+    """Wait for a process launched by Popen, killing it once the deadline of the job passes"""
+    try:
+      return proc.communicate(timeout=self.RemainingTime)
+    except subprocess.TimeoutExpired:
+      self.Kill(proc)
+      self.CheckDeadline(Command)
+      raise
+    except BaseException:
+      # Do not leave anything running behind an interrupted job
+      self.Kill(proc)
+      raise
+    finally:
+      with self.ProcessesLock:
+        self.Processes.discard(proc)
+
+  def CheckOutput(self, Command, *, Limited=True, NumProcesses=1, stderr=subprocess.STDOUT):
+    """Governed equivalent of subprocess.check_output(Command, stderr=stderr)
+
+    :param Limited: False spares the process the rlimits, it still gets the deadline
+    :param stderr: subprocess.PIPE keeps the errors out of the output, they are then on the CalledProcessError
+    """
+    proc = self.Popen(Command, Limited=Limited, NumProcesses=NumProcesses, stdout=subprocess.PIPE, stderr=stderr)
+    out, err = self.Wait(proc, Command)
+    if proc.returncode:
+      raise subprocess.CalledProcessError(proc.returncode, Command, output=out, stderr=err)
+    return out
+
+  def Call(self, Command, *, Limited=True):
+    """Governed equivalent of subprocess.call(Command, stderr=subprocess.STDOUT)"""
+    proc = self.Popen(Command, Limited=Limited, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    self.Wait(proc, Command)
+    return proc.returncode
+
+
+Governor = ResourceGovernorClass()
+
+
 class NoMoreRetriesException(Exception):
   """This exception signifies that the job cannot be retried any more times"""
   pass
 
 
+class PostponeJobException(NoMoreRetriesException):
+  """This exception signifies that the job cannot run for now, it is posted again as is after Delay seconds"""
+
+  def __init__(self, message, *, Delay):
+    super().__init__(message)
+    self.Delay = Delay
+
+
+class JobTimeoutException(NoMoreRetriesException):
+  """This exception signifies that the job overran its deadline, it would most likely overrun it again"""
+  pass
+
+
 def JobWithName(jobname):
   assert isinstance(jobname, str)
   def Job(func):
@@ -148,6 +422,7 @@ class S3BackedFile():
     self.Config = Config
     self.Logger = Logger
     self.Binaries = Binaries
+    self.Governor = Governor
     # Mainly populated by child class
     self.Output = {
       'state': 'PROGRESSING',
@@ -156,37 +431,101 @@ class S3BackedFile():
       'Input': {},
       'Outputs': [],
       }
+    # Where self.Output is written
+    self.OutputJSONKey = os.path.join(self.OutputKeyPrefix, "output.json")
+    # Set by jobs whose output is completed by other jobs, output.json is then left as is on success
+    self.Deferred = False
+    # Options making convert decode the input at a reduced resolution, set by Preflight
+    self.DecodeOptions = ()
+    # Guards self.Output, which may be updated from several threads
+    self.OutputLock = threading.RLock()
     self._LocalFilePath = None
     self._FilePathsToCleanup = []
+    self._LastProgressTime = 0
+    self._Finished = False
+    # Snapshots of self.Output are numbered, a write never replaces a newer one in S3
+    self._OutputSequence = 0
+    self._WrittenSequence = 0
+    self._WriteLock = threading.Lock()
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
-    # Figure out the state of the job
-    if not exc_type:
-      self.Output['state'] = 'COMPLETED'
-    else:
-      self.Output['state'] = 'ERROR'
-      self.Output['Error'] = exc_value
-
-    # Write to output.json if there was no exception
-    S3.PutJSON(
-      session=self.Config.Session,
-      bucket=self.Config.S3_OutputBucket,
-      key=os.path.join(self.OutputKeyPrefix, "output.json"),
-      content=self.Output
-      )
-    self.Logger.debug("Wrote output.json")
+    # A postponed job runs again later, it has not failed and leaves output.json as is
+    Postponed = isinstance(exc_value, PostponeJobException)
+    with self.OutputLock:
+      # Figure out the state of the job
+      if not exc_type:
+        self.Output['state'] = 'COMPLETED'
+      else:
+        self.Output['state'] = 'ERROR'
+        self.Output['Error'] = str(exc_value)
+        self.Output['TimedOut'] = isinstance(exc_value, JobTimeoutException)
+
+      # Write to output.json, no progress may be written after this
+      if not Postponed and (exc_type or not self.Deferred):
+        self.WriteOutput()
+        self.Logger.debug("Wrote output.json")
+      self._Finished = True
     self.Logger.debug(self.Output)
 
     # We're done with temp files, delete it
+    self.Cleanup()
+
+  def Cleanup(self):
+    """Delete the temp files of the job, EX: of a job left for another worker that never ran"""
     if len(self._FilePathsToCleanup):
       for fpath in self._FilePathsToCleanup:
         if os.path.exists(fpath):
           os.remove(fpath)
           self.Logger.debug("Removed {0}".format(fpath))
 
+  def WriteOutput(self, Progress=False):
+    """Write a snapshot of self.Output to output.json
+
+    Only the snapshot is taken under OutputLock, so that the threads adding outputs do not
+    wait for S3. A snapshot older than the one last written is dropped.
+
+    :param Progress: True for progress, which is no longer written once the job has finished
+    :return: True if the snapshot has been written
+    :rtype: bool
+    """
+    with self.OutputLock:
+      if Progress and self._Finished:
+        return False
+      self._OutputSequence += 1
+      Sequence = self._OutputSequence
+      content = json.dumps(self.Output)
+    with self._WriteLock:
+      if Sequence < self._WrittenSequence:
+        return False
+      S3.PutObject(
+        session=self.Config.Session,
+        bucket=self.Config.S3_OutputBucket,
+        key=self.OutputJSONKey,
+        content=content,
+        type_="application/json"
+        )
+      self._WrittenSequence = Sequence
+    return True
+
+  def PublishProgress(self, Force=False):
+    """Write the outputs finished so far to output.json while the job is still progressing
+
+    Writes are throttled to one every Jobs.ProgressInterval seconds unless forced.
+    """
+    with self.OutputLock:
+      now = time.time()
+      if self._Finished or (not Force and now - self._LastProgressTime < (self.Config.Jobs_ProgressInterval or PROGRESS_INTERVAL)):
+        return False
+      self._LastProgressTime = now
+    # The write itself happens outside the lock, a newer snapshot may have been written meanwhile
+    if not self.WriteOutput(Progress=True):
+      return False
+    self.Logger.debug("Wrote progress to output.json")
+    return True
+
   @property
   def LocalFilePath(self):
     # Check if we've already downloaded the file from S3
@@ -221,20 +560,85 @@ class S3BackedFile():
   def MarkFilePathForCleanup(self, FilePath):
     self._FilePathsToCleanup.append(FilePath)
 
-  def InspectImage(self, FilePath):
-    out = subprocess.check_output((Binaries.Identify, FilePath), stderr=subprocess.STDOUT)
-    parts = out.decode('utf-8').split(' ')
-    ftype = parts[1]
-    fsize = parts[2]
-    fsize_parts = fsize.split('x')
-    fwidth = fsize_parts[0]
-    fheight = fsize_parts[1]
+  def Preflight(self, FilePath, AllFrames=False):
+    """Check the dimensions declared in the image header before anything decodes the image
+
+    Impossible images are rejected, oversize JPEGs are set up to be scaled down while loading.
+
+    :param AllFrames: True when every frame is decoded at once, their pixels then count together
+    """
+    MaxDecodePixels = self.Config.Image_MaxDecodePixels or MAX_DECODE_PIXELS
+    MaxInputPixels = self.Config.Image_MaxInputPixels or MAX_INPUT_PIXELS
+    MaxInputFrames = self.Config.Image_MaxInputFrames or MAX_INPUT_FRAMES
+    # -ping only reads the headers so that we never decode pixels here
+    try:
+      out = self.Governor.CheckOutput((self.Binaries.Identify, '-ping', '-format', '%m %w %h\n', FilePath))
+    except subprocess.CalledProcessError as exc:
+      raise NoMoreRetriesException("ERROR: could not read the header of {0}: {1}".format(self.InputKey, exc.output.decode('utf-8', 'replace').strip()))
+    frames = [line.split() for line in out.decode('utf-8').splitlines() if line.strip()]
+    if not frames:
+      raise NoMoreRetriesException("ERROR: {0} does not contain any image".format(self.InputKey))
+    ftype = frames[0][0]
+    fwidth = int(frames[0][1])
+    fheight = int(frames[0][2])
+    if AllFrames:
+      numpixels = sum(int(f[1]) * int(f[2]) for f in frames)
+    else:
+      numpixels = max(int(f[1]) * int(f[2]) for f in frames)
+    # Reject anything that would pin a worker
+    if len(frames) > MaxInputFrames:
+      raise NoMoreRetriesException("ERROR: {0} has {1} frames, at most {2} are allowed".format(self.InputKey, len(frames), MaxInputFrames))
+    if numpixels > MaxInputPixels:
+      if AllFrames and len(frames) > 1:
+        raise NoMoreRetriesException("ERROR: the {0} frames of {1} have {2} pixels, at most {3} pixels are allowed".format(len(frames), self.InputKey, numpixels, MaxInputPixels))
+      raise NoMoreRetriesException("ERROR: {0} is {1}x{2} pixels, at most {3} pixels are allowed".format(self.InputKey, fwidth, fheight, MaxInputPixels))
+    # Large JPEGs can be scaled down by the decoder itself
+    if numpixels > MaxDecodePixels:
+      if ftype == 'JPEG':
+        scale = math.sqrt(MaxDecodePixels / numpixels)
+        self.DecodeOptions = ('-define', 'jpeg:size={0}x{1}'.format(math.ceil(fwidth * scale), math.ceil(fheight * scale)))
+        self.Logger.debug("{0} will be decoded at a reduced resolution".format(self.InputKey))
+      else:
+        self.Logger.info("{0} is {1}x{2} pixels and will be decoded at full resolution".format(self.InputKey, fwidth, fheight))
     return {
       "Type": ftype,
-      "Width": int(fwidth),
-      "Height": int(fheight),
+      "Width": fwidth,
+      "Height": fheight,
+      "NumFrames": len(frames),
       }
 
+  def InspectImage(self, FilePath):
+    return self.InspectImages([FilePath])[0]
+
+  def InspectImages(self, FilePaths):
+    """Get the type and dimensions of several images with a single identify
+
+    :param FilePaths: Paths of the images
+    :type FilePaths: list
+    :return: Properties of every image, in the order of the paths
+    :rtype: list
+    """
+    if not FilePaths:
+      return []
+    # -ping only reads the headers, which is all we need here
+    out = self.Governor.CheckOutput((self.Binaries.Identify, '-ping', '-format', IDENTIFY_FORMAT) + tuple(FilePaths))
+    props = {}
+    for line in out.decode('utf-8').splitlines():
+      parts = line.split(' ', 3)
+      if len(parts) < 4:
+        continue
+      ftype, fwidth, fheight, fpath = parts
+      # Images with several frames print a line per frame, the first one describes the image
+      props.setdefault(fpath, {
+        "Type": ftype,
+        "Width": int(fwidth),
+        "Height": int(fheight),
+        })
+    missing = [fpath for fpath in FilePaths if fpath not in props]
+    if missing:
+      raise Exception("ERROR: could not identify {0}".format(', '.join(missing)))
+    return [dict(props[fpath]) for fpath in FilePaths]
+
 
 def ProcessMessage(*, Message, Config, Logger):
   """Process a message
@@ -283,16 +687,26 @@ def ProcessMessage(*, Message, Config, Logger):
   # It is assumed that every job is available as a module in the Jobs package.
   jobs_func = JOBS_MAP.get(m['Job'])
   if callable(jobs_func):
-    return jobs_func(Config=Config, Logger=Logger, **m['Params'])
+    # Every process launched by the job shares its deadline
+    Deadline = (Config.Jobs_Deadlines or {}).get(m['Job']) or JOB_DEADLINES.get(m['Job']) or Config.Jobs_Deadline or JOB_DEADLINE
+    Governor.StartDeadline(Deadline)
+    try:
+      return jobs_func(Config=Config, Logger=Logger, **m['Params'])
+    finally:
+      Governor.StartDeadline(None)
   else:
     Logger.error("Could not find a job handler for {0}".format(m['Job']))
   return None
 
 
-def Run(*, DataDirPath, Config, Logger, SleepAmount=20):
+def Run(*, DataDirPath, Config, Logger, SleepAmount=20, NumConcurrentJobs=1):
   # Change data directory to that which is specified on the command line
   global DATADIR_PATH
   DATADIR_PATH = DataDirPath
+  # Share the resources of this host with the other jobs processors running on it
+  Governor.NumConcurrentJobs = NumConcurrentJobs
+  # Deadlines hold even outside of external processes, and nothing outlives the jobs processor
+  Governor.InstallSignalHandlers()
 
   # Import all the other modules in this package
   # This way, we make sure that all the jobs are registered and ready to use while processing
@@ -317,6 +731,12 @@ def Run(*, DataDirPath, Config, Logger, SleepAmount=20):
       m, receipt_handle = SQS.GetMessageFromQueue(session, QueueUrl, delete_after_receive=True)
       Logger.debug("Message recieved {0}".format(str(m)))
       ProcessMessage(Message=m, Config=Config, Logger=Logger)
+    except PostponeJobException as exc:
+      # Post the message again as is so that postponing does not use up its retries
+      Logger.info("Postponing job {0} by {1} seconds: {2}".format(m, exc.Delay, exc))
+      SQS.PostMessage(session, QueueUrl, m, delay_seconds=exc.Delay)
+    except JobTimeoutException as exc:
+      Logger.error("TIMEOUT: {0} while processing job {1}".format(exc, m))
     except NoMoreRetriesException:
       pass
     except (KeyboardInterrupt, SystemExit):
@@ -15,15 +15,42 @@ import uno
 import sys
 sys.path.append("/usr/bin/soffice")
 
+import os
+import json
+import hashlib
+import time
+import signal
+import socket
+import shutil
+import argparse
+import threading
+import subprocess
+import Queue
+import SocketServer
+
 from os.path import abspath, isfile, splitext
 from com.sun.star.beans import PropertyValue
 from com.sun.star.task import ErrorCodeIOException
 from com.sun.star.connection import NoConnectException
+from com.sun.star.lang import DisposedException
+from com.sun.star.uno import RuntimeException
 
 
 DEFAULT_OPENOFFICE_HOST = 'localhost'
 DEFAULT_OPENOFFICE_PORT = 8100
 
+# Office instances managed by the converter service listen on consecutive ports starting here
+DEFAULT_POOL_BASE_PORT = 8200
+# Each managed instance is restarted after this many conversions
+DEFAULT_MAX_CONVERSIONS = 200
+# A conversion taking longer than this many seconds gets its instance killed
+DEFAULT_CONVERSION_TIMEOUT = 300
+# Seconds to wait for a freshly started instance to accept connections
+DEFAULT_STARTUP_TIMEOUT = 60
+# Conversions depend on the filter settings below as much as on the office
+with open(abspath(__file__), "rb") as fp:
+    SCRIPT_DIGEST = hashlib.sha256(fp.read()).hexdigest()
+
 
 FAMILY_TEXT = "Text"
 FAMILY_WEB = "Web"
@@ -132,17 +159,37 @@ class DocumentConverter:
 
     def __init__(self, host=DEFAULT_OPENOFFICE_HOST, port=DEFAULT_OPENOFFICE_PORT):
         localContext = uno.getComponentContext()
-        resolver = localContext.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", localContext)
+        # The bridge is built by hand rather than with a UnoUrlResolver so that it can be disposed of
+        connector = localContext.ServiceManager.createInstanceWithContext("com.sun.star.connection.Connector", localContext)
         try:
-            context = resolver.resolve("uno:socket,host=%s,port=%s;urp;StarOffice.ComponentContext" % (host, port))
+            connection = connector.connect("socket,host=%s,port=%s" % (host, port))
         except NoConnectException:
             raise DocumentConversionException("failed to connect to OpenOffice.org on addr %s:%s" % (host, port))
-        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+        bridgeFactory = localContext.ServiceManager.createInstanceWithContext("com.sun.star.bridge.BridgeFactory", localContext)
+        self.bridge = bridgeFactory.createBridge("", "urp", connection, None)
+        self.context = self.bridge.getInstance("StarOffice.ComponentContext")
+        self.desktop = self.context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", self.context)
 
-    def convert(self, inputFile, outputFile):
+    def disconnect(self):
+        # Calls pending on the bridge fail with a DisposedException, the office itself is left running
+        self.bridge.dispose()
 
+    def convert(self, inputFile, outputFile):
+        self.convertMany(inputFile, [outputFile])
+
+    def version(self):
+        """Name and version of the office, as its about box shows them"""
+        provider = self.context.ServiceManager.createInstanceWithContext("com.sun.star.configuration.ConfigurationProvider", self.context)
+        product = provider.createInstanceWithArguments("com.sun.star.configuration.ConfigurationAccess", self._toProperties({"nodepath": "/org.openoffice.Setup/Product"}))
+        # The about box version has the micro version too, older offices only have the short one
+        for name in ("ooSetupVersionAboutBox", "ooSetupVersion"):
+            if product.hasByName(name) and product.getByName(name):
+                return "%s %s" % (product.getByName("ooName"), product.getByName(name))
+        return product.getByName("ooName")
+
+    def convertMany(self, inputFile, outputFiles):
+        # Loading is the expensive part, every output is exported from the same loaded document
         inputUrl = self._toFileUrl(inputFile)
-        outputUrl = self._toFileUrl(outputFile)
 
         loadProperties = { "Hidden": True }
         inputExt = self._getFileExt(inputFile)
@@ -158,11 +205,14 @@ class DocumentConverter:
         family = self._detectFamily(document)
         self._overridePageStyleProperties(document, family)
 
-        outputExt = self._getFileExt(outputFile)
-        storeProperties = self._getStoreProperties(document, outputExt)
-
         try:
-            document.storeToURL(outputUrl, self._toProperties(storeProperties))
+            # Unsupported formats are reported before anything is written
+            stores = [
+                (self._toFileUrl(outputFile), self._getStoreProperties(document, self._getFileExt(outputFile)))
+                for outputFile in outputFiles
+                ]
+            for outputUrl, storeProperties in stores:
+                document.storeToURL(outputUrl, self._toProperties(storeProperties))
         finally:
             document.close(True)
 
@@ -218,20 +268,350 @@ class DocumentConverter:
         return tuple(props)
 
 
-if __name__ == "__main__":
-    import os
+class ConversionRequestHandler(SocketServer.StreamRequestHandler):
+    """Handles one JSON encoded request per line: {"input": <path>, "output": <path>}
+
+    Several formats are exported from a single load with {"input": <path>, "outputs": [<path>, ...]}
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                response = {"ok": True}
+                if request.get("check"):
+                    # {"check": true} makes sure an office accepts conversions
+                    self.server.pool.check()
+                elif request.get("version"):
+                    # {"version": true} tells what the conversions depend on: the office and the filter settings of this script
+                    response["version"] = "%s %s" % (self.server.pool.version(), SCRIPT_DIGEST)
+                else:
+                    self.server.convert(request["input"], request.get("outputs") or [request["output"]])
+            except DocumentConversionException as exception:
+                response = {"ok": False, "error": str(exception)}
+            except ErrorCodeIOException as exception:
+                response = {"ok": False, "error": "ErrorCodeIOException %d" % exception.ErrCode}
+            except Exception as exception:
+                response = {"ok": False, "error": "%s: %s" % (type(exception).__name__, exception)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class OfficeInstance(object):
+    """An office the converter service converts with, restarted when it misbehaves
+
+    Managed instances are headless soffice processes with their own port and profile
+    directory. An unmanaged instance only connects to an office started elsewhere.
+    """
+
+    def __init__(self, host, port, managed=True, maxConversions=DEFAULT_MAX_CONVERSIONS, timeout=DEFAULT_CONVERSION_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.managed = managed
+        self.maxConversions = maxConversions
+        self.timeout = timeout
+        self.profileDir = "/tmp/docstruct-soffice-%d" % port
+        self.process = None
+        self.converter = None
+        self.numConversions = 0
+        self.timedOut = False
+
+    def start(self):
+        if self.managed:
+            # The office leads a process group of its own: soffice starts soffice.bin, which must go along with it
+            self.process = subprocess.Popen((
+                os.environ.get("SOFFICE_BINARY", "soffice"),
+                "--headless", "--invisible", "--nologo", "--norestore", "--nodefault", "--nofirststartwizard",
+                "--accept=socket,host=%s,port=%d;urp;" % (self.host, self.port),
+                "-env:UserInstallation=%s" % uno.systemPathToFileUrl(self.profileDir),
+                ), preexec_fn=os.setsid)
+        # Wait for the office to accept connections
+        deadline = time.time() + (DEFAULT_STARTUP_TIMEOUT if self.managed else 0)
+        while True:
+            try:
+                self.converter = DocumentConverter(host=self.host, port=self.port)
+                break
+            except DocumentConversionException:
+                if time.time() >= deadline:
+                    self.stop()
+                    raise
+                time.sleep(0.5)
+        self.numConversions = 0
+
+    def killProcessGroup(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # Everything in the group has exited already
+            pass
+
+    def stop(self):
+        converter, self.converter = self.converter, None
+        if self.process is not None:
+            # soffice.bin may outlive the soffice wrapper and keep the port, so the whole group goes
+            self.killProcessGroup()
+            self.process.wait()
+            self.process = None
+        elif converter is not None:
+            try:
+                converter.disconnect()
+            except Exception:
+                pass
+
+    def kill(self):
+        # Called by the watchdog, the pending conversion fails with a bridge error
+        self.timedOut = True
+        if self.process is not None:
+            self.killProcessGroup()
+        elif self.converter is not None:
+            # An office started elsewhere is not ours to kill, give up on it instead. It may
+            # keep working on the document, but this instance reconnects on its next conversion.
+            self.converter.disconnect()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def ensureStarted(self):
+        if self.converter is None or (self.process is not None and self.process.poll() is not None):
+            self.restart()
+
+    def version(self):
+        self.ensureStarted()
+        try:
+            return self.converter.version()
+        except (DisposedException, RuntimeException):
+            # The office went away since we connected
+            self.restart()
+            return self.converter.version()
+
+    def convert(self, inputFile, outputFiles):
+        self.ensureStarted()
+        self.timedOut = False
+        watchdog = threading.Timer(self.timeout, self.kill)
+        watchdog.start()
+        try:
+            try:
+                self.converter.convertMany(inputFile, outputFiles)
+            except (DisposedException, RuntimeException):
+                if self.timedOut:
+                    raise DocumentConversionException("conversion timed out after %d seconds" % self.timeout)
+                # The office went away since we connected: restart and try once more
+                self.restart()
+                self.converter.convertMany(inputFile, outputFiles)
+        except DocumentConversionException:
+            if self.timedOut:
+                self.stop()
+            raise
+        finally:
+            watchdog.cancel()
+        self.numConversions += 1
+        # Recycle managed instances before they accumulate leaks, they start again on next use
+        if self.managed and self.numConversions >= self.maxConversions:
+            self.stop()
+
+
+class OfficePool(object):
+    """Dispatches conversions to idle office instances"""
+
+    def __init__(self, instances):
+        self.instances = list(instances)
+        # Every instance runs the same office, its version is asked once
+        self.officeVersion = None
+        self.idle = Queue.Queue()
+        for instance in self.instances:
+            self.idle.put(instance)
+
+    def convert(self, inputFile, outputFiles):
+        instance = self.idle.get()
+        try:
+            instance.convert(inputFile, outputFiles)
+        finally:
+            self.idle.put(instance)
+
+    def check(self):
+        """Make sure an office accepts connections, starting one if none is running"""
+        instance = self.idle.get()
+        try:
+            instance.ensureStarted()
+        finally:
+            self.idle.put(instance)
+
+    def version(self):
+        if self.officeVersion is None:
+            instance = self.idle.get()
+            try:
+                self.officeVersion = instance.version()
+            finally:
+                self.idle.put(instance)
+        return self.officeVersion
 
+    def close(self):
+        for instance in self.instances:
+            instance.stop()
+            shutil.rmtree(instance.profileDir, ignore_errors=True)
+
+
+class ConversionServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Converts documents sent over a unix socket with a pool of office instances"""
+
+    daemon_threads = True
+
+    def __init__(self, socketPath, pool):
+        self.pool = pool
+        SocketServer.UnixStreamServer.__init__(self, socketPath, ConversionRequestHandler)
+
+    def convert(self, inputFile, outputFiles):
+        if not isfile(inputFile):
+            raise DocumentConversionException("no such input file: %s" % inputFile)
+        self.pool.convert(inputFile, outputFiles)
+
+
+def parseBatchLine(line):
+    # Either a request as sent to the service, or an input and an output separated by a tab
+    line = line.strip()
+    if line.startswith("{"):
+        request = json.loads(line)
+        return request["input"], request.get("outputs") or [request["output"]]
+    inputFile, outputFile = line.split("\t")
+    return inputFile, [outputFile]
+
+
+def batch(lines, results, instance):
+    """Convert every input/output pair over a single connection, whatever happens to each of them
+
+    A JSON line is written to results for every pair: {"input", "outputs", "ok", "seconds"}
+    with an "error" when the conversion failed.
+
+    :return: the number of failed conversions
+    """
+    numErrors = 0
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            start = time.time()
+            result = {"input": None, "outputs": [], "ok": False}
+            try:
+                result["input"], result["outputs"] = parseBatchLine(line)
+                if not isfile(result["input"]):
+                    raise DocumentConversionException("no such input file: %s" % result["input"])
+                instance.convert(result["input"], result["outputs"])
+                result["ok"] = True
+            except DocumentConversionException as exception:
+                result["error"] = str(exception)
+            except ErrorCodeIOException as exception:
+                result["error"] = "ErrorCodeIOException %d" % exception.ErrCode
+            except Exception as exception:
+                result["error"] = "%s: %s" % (type(exception).__name__, exception)
+            if not result["ok"]:
+                numErrors += 1
+            result["seconds"] = round(time.time() - start, 3)
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+    finally:
+        instance.stop()
+        if instance.managed:
+            shutil.rmtree(instance.profileDir, ignore_errors=True)
+    return numErrors
+
+
+def serve(socketPath, pool):
+    # Only one service may listen on a socket, a stale socket file is left by a service that died
+    if os.path.exists(socketPath):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socketPath)
+        except socket.error:
+            os.remove(socketPath)
+        else:
+            print("a converter service is already listening on %s" % socketPath)
+            return
+        finally:
+            probe.close()
+    server = ConversionServer(socketPath, pool)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
+        os.remove(socketPath)
+
+
+if __name__ == "__main__":
+    envvarname = os.environ.get('OO_HOST_VAR', 'OOSERVER_PORT_8100_TCP_ADDR')
+    host = os.environ.get(envvarname, DEFAULT_OPENOFFICE_HOST)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        parser = argparse.ArgumentParser(description="Serves document conversions over a unix socket")
+        parser.add_argument("--serve", dest="socketPath", required=True, help="Path of the unix socket to listen on")
+        parser.add_argument("--pool-size", dest="poolSize", type=int, default=1,
+            help="Number of office instances to start. With 0, the office at the host named by $%s is used." % envvarname)
+        parser.add_argument("--base-port", dest="basePort", type=int, default=DEFAULT_POOL_BASE_PORT)
+        parser.add_argument("--max-conversions", dest="maxConversions", type=int, default=DEFAULT_MAX_CONVERSIONS)
+        parser.add_argument("--timeout", dest="timeout", type=int, default=DEFAULT_CONVERSION_TIMEOUT)
+        args = parser.parse_args()
+        # An office running elsewhere (ex: a linked container) is used as is
+        if args.poolSize < 1 or envvarname in os.environ:
+            instances = [OfficeInstance(host, DEFAULT_OPENOFFICE_PORT, managed=False, timeout=args.timeout)]
+        else:
+            instances = [
+                OfficeInstance("127.0.0.1", args.basePort + i, maxConversions=args.maxConversions, timeout=args.timeout)
+                for i in range(args.poolSize)
+                ]
+        serve(args.socketPath, OfficePool(instances))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        parser = argparse.ArgumentParser(description="Converts many documents over a single office connection")
+        parser.add_argument("--batch", dest="manifest", required=True,
+            help="File with one conversion per line, either a JSON request or <input>TAB<output>. Use - for stdin.")
+        parser.add_argument("--results", dest="results", default="-", help="File to which a JSON result per conversion is written")
+        parser.add_argument("--managed", action="store_true", help="Start a headless office for the batch instead of using the one at $%s" % envvarname)
+        parser.add_argument("--port", dest="port", type=int, default=DEFAULT_OPENOFFICE_PORT)
+        parser.add_argument("--max-conversions", dest="maxConversions", type=int, default=DEFAULT_MAX_CONVERSIONS)
+        parser.add_argument("--timeout", dest="timeout", type=int, default=DEFAULT_CONVERSION_TIMEOUT)
+        args = parser.parse_args()
+        if args.managed:
+            instance = OfficeInstance("127.0.0.1", args.port, maxConversions=args.maxConversions, timeout=args.timeout)
+        else:
+            instance = OfficeInstance(host, args.port, managed=False, timeout=args.timeout)
+        lines = sys.stdin if args.manifest == "-" else open(args.manifest)
+        results = sys.stdout if args.results == "-" else open(args.results, "w")
+
+        def stopBatch(signum, frame):
+            # The office leads a session of its own, the signals sent to our process group do not reach it
+            instance.stop()
+            if instance.managed:
+                shutil.rmtree(instance.profileDir, ignore_errors=True)
+            os._exit(128 + signum)
+
+        # Signal handlers only run in the main thread, and only between calls to the office:
+        # the batch runs in another thread so that the main one is always there to stop it
+        signal.signal(signal.SIGTERM, stopBatch)
+        outcome = []
+        worker = threading.Thread(target=lambda: outcome.append(batch(lines, results, instance)))
+        worker.daemon = True
+        worker.start()
+        while worker.isAlive():
+            worker.join(1)
+        lines.close()
+        results.close()
+        sys.exit(1 if not outcome or outcome[0] else 0)
     if len(sys.argv) < 3:
-        print("USAGE: python %s <input-file> <output-file>" % sys.argv[0])
+        print("USAGE: python %s <input-file> <output-file> [<output-file> ...]" % sys.argv[0])
+        print("       python %s --serve <socket-path> [--pool-size N] [--max-conversions K] [--timeout SECONDS]" % sys.argv[0])
+        print("       python %s --batch <manifest|-> [--results <path>] [--managed] [--port N] [--timeout SECONDS]" % sys.argv[0])
         sys.exit(255)
     if not isfile(sys.argv[1]):
         print("no such input file: %s" % sys.argv[1])
         sys.exit(1)
 
     try:
-        envvarname = os.environ.get('OO_HOST_VAR', 'OOSERVER_PORT_8100_TCP_ADDR')
-        converter = DocumentConverter(host=os.environ.get(envvarname, DEFAULT_OPENOFFICE_HOST))
-        converter.convert(sys.argv[1], sys.argv[2])
+        converter = DocumentConverter(host=host)
+        converter.convertMany(sys.argv[1], sys.argv[2:])
     except DocumentConversionException as exception:
         print("ERROR! " + str(exception))
         sys.exit(1)
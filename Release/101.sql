@@ -0,0 +1,8 @@
+BEGIN TRANSACTION;
+
+ALTER TABLE "AWS"."S3_File_Document_Page" ADD COLUMN "SpriteX" int4;
+ALTER TABLE "AWS"."S3_File_Document_Page" ADD COLUMN "SpriteY" int4;
+
+UPDATE "AWS"."Release" SET "Version" = '1.1.0';
+
+END
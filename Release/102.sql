@@ -0,0 +1,7 @@
+BEGIN TRANSACTION;
+
+INSERT INTO "AWS"."VideoVersion" ("VideoVersion", "HTML_Type") VALUES ('HLS', 'application/vnd.apple.mpegurl');
+
+UPDATE "AWS"."Release" SET "Version" = '1.2.0';
+
+END